@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional
+from http_client import HttpClient
+from stream_resolver import ResolvedStream
+
+# Disk budget for cached online tracks; 0 disables the cache
+AUDIO_CACHE_MB = float(os.getenv("AUDIO_CACHE_MB", "512"))
+# A track is downloaded once it has been played this many times
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))
+# Inside the music/ mount, so cached files are also reachable as /music/cache/<file>
+AUDIO_CACHE_DIR = os.path.join("music", "cache")
+# Play counts kept for tracks that are not cached (yet)
+MAX_TRACKED = 1000
+MAX_PARALLEL_DOWNLOADS = 2
+
+class AudioCache:
+    """Disk tier for frequently played online tracks.
+
+    Each play of an online track is counted; once a track reaches
+    `min_plays` it is downloaded in the background and later plays are
+    served from the local file. When the total size exceeds the budget,
+    the least played (then least recently played) files are evicted.
+    The index lives in <cache_dir>/index.json.
+    """
+
+    def __init__(self, http: HttpClient, cache_dir: str = AUDIO_CACHE_DIR,
+                 max_bytes: int = int(AUDIO_CACHE_MB * 1024 * 1024), min_plays: int = AUDIO_CACHE_MIN_PLAYS):
+        self.http = http
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_plays = max(1, min_plays)
+        self.enabled = max_bytes > 0
+        self.index_path = os.path.join(cache_dir, "index.json")
+        # video_id -> {plays, last_played, title, thumbnail, ext, file, size}
+        self._tracks: Dict[str, Dict] = {}
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self.stats = {"hits": 0, "downloads": 0, "download_errors": 0, "evictions": 0}
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._tracks = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Error loading audio cache index: {e}")
+        # Forget files that disappeared and drop interrupted downloads
+        for track in self._tracks.values():
+            if track.get("file") and not os.path.exists(os.path.join(self.cache_dir, track["file"])):
+                track["file"] = None
+                track["size"] = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".part"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._tracks, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _file_name(video_id: str, ext: Optional[str]) -> str:
+        if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", video_id):
+            base = video_id
+        else:
+            base = hashlib.sha1(video_id.encode("utf-8")).hexdigest()
+        return f"{base}.{ext or 'm4a'}"
+
+    def lookup(self, video_id: str, count_play: bool = True) -> Optional[Dict]:
+        """The cached track for a video if its file is on disk"""
+        if not self.enabled:
+            return None
+        track = self._tracks.get(video_id)
+        if not track or not track.get("file"):
+            return None
+        self.stats["hits"] += 1
+        if count_play:
+            track["plays"] += 1
+            track["last_played"] = time.time()
+            self._save_index()
+        return {**track, "path": os.path.join(self.cache_dir, track["file"])}
+
+    def record_play(self, video_id: str, stream: ResolvedStream, headers: Dict[str, str]):
+        """Count a play served upstream; start the download once the track is popular enough"""
+        if not self.enabled:
+            return
+        track = self._tracks.setdefault(video_id, {"plays": 0, "file": None, "size": 0})
+        track["plays"] += 1
+        track["last_played"] = time.time()
+        track["title"] = stream.title or track.get("title") or video_id
+        track["thumbnail"] = stream.thumbnail or track.get("thumbnail")
+        track["ext"] = stream.ext
+        if (track["plays"] >= self.min_plays and not track["file"]
+                and video_id not in self._downloads and len(self._downloads) < MAX_PARALLEL_DOWNLOADS):
+            task = asyncio.ensure_future(self._download(video_id, stream.url, dict(headers)))
+            self._downloads[video_id] = task
+            task.add_done_callback(lambda _: self._downloads.pop(video_id, None))
+        self._forget_untracked()
+        self._save_index()
+
+    async def _download(self, video_id: str, url: str, headers: Dict[str, str]):
+        track = self._tracks[video_id]
+        file_name = self._file_name(video_id, track.get("ext"))
+        path = os.path.join(self.cache_dir, file_name)
+        part_path = path + ".part"
+        loop = asyncio.get_event_loop()
+        try:
+            async with self.http.stream("GET", url, headers=headers, timeout=60) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"HTTP {response.status_code}")
+                with open(part_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(256 * 1024):
+                        # Disk writes stay off the event loop, as for uploads
+                        await loop.run_in_executor(None, f.write, chunk)
+            os.replace(part_path, path)
+        except BaseException as e:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            print(f"Audio cache download error ({video_id}): {e}")
+            self.stats["download_errors"] += 1
+            return
+        track["file"] = file_name
+        track["size"] = os.path.getsize(path)
+        self.stats["downloads"] += 1
+        self._evict(keep=video_id)
+        self._save_index()
+
+    def _evict(self, keep: str):
+        cached = [(vid, t) for vid, t in self._tracks.items() if t.get("file")]
+        total = sum(t["size"] for _, t in cached)
+        # LFU, ties broken by least recently played
+        cached.sort(key=lambda item: (item[1]["plays"], item[1].get("last_played", 0)))
+        for video_id, track in cached:
+            if total <= self.max_bytes:
+                break
+            if video_id == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, track["file"]))
+            except OSError as e:
+                print(f"Error evicting cached track {video_id}: {e}")
+            total -= track["size"]
+            track["file"] = None
+            track["size"] = 0
+            self.stats["evictions"] += 1
+
+    def _forget_untracked(self):
+        uncached = [vid for vid, t in self._tracks.items() if not t.get("file")]
+        if len(uncached) <= MAX_TRACKED:
+            return
+        uncached.sort(key=lambda vid: self._tracks[vid].get("last_played", 0))
+        for video_id in uncached[:len(uncached) - MAX_TRACKED]:
+            if video_id not in self._downloads:
+                del self._tracks[video_id]
+
+    def list_cached(self) -> List[Dict]:
+        """Cached tracks, most played first"""
+        tracks = [{"id": vid, **t} for vid, t in self._tracks.items() if t.get("file")]
+        tracks.sort(key=lambda t: t["plays"], reverse=True)
+        return tracks
+
+    async def aclose(self):
+        for task in list(self._downloads.values()):
+            task.cancel()
+
+    def get_stats(self) -> dict:
+        cached = self.list_cached()
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "cached_tracks": len(cached),
+            "cached_bytes": sum(t["size"] for t in cached),
+            "downloading": len(self._downloads),
+        }
@@ -0,0 +1,97 @@
+"""Compare the streaming feed parser with the old regex scraping on large generated feeds.
+
+Usage: python bench_feed_parser.py [items ...]
+"""
+import re
+import sys
+import time
+from datetime import datetime
+from feed_parser import FeedParser, parse_feed
+from news_service import NewsService
+
+def regex_parse_piapro(content, classify):
+    """The previous regex-based Piapro parser, kept here as the baseline"""
+    items = re.findall(r'<item>(.*?)</item>', content, re.DOTALL)
+    news_items = []
+    for item in items:
+        title_match = re.search(r'<title>(.*?)</title>', item)
+        title = title_match.group(1) if title_match else "No Title"
+        title = title.replace('<![CDATA[', '').replace(']]>', '')
+        link_match = re.search(r'<link>(.*?)</link>', item)
+        link = link_match.group(1) if link_match else ""
+        date_match = re.search(r'<pubDate>(.*?)</pubDate>', item)
+        pub_date = date_match.group(1) if date_match else ""
+        try:
+            dt = datetime.strptime(pub_date, "%a, %d %b %Y %H:%M:%S %z")
+            pub_date = dt.strftime("%Y-%m-%d %H:%M")
+        except ValueError:
+            pass
+        desc_match = re.search(r'<content:encoded>(.*?)</content:encoded>', item, re.DOTALL)
+        if not desc_match:
+            desc_match = re.search(r'<description>(.*?)</description>', item, re.DOTALL)
+        desc = desc_match.group(1) if desc_match else ""
+        desc_clean = re.sub(r'<[^>]+>', '', desc).replace('<![CDATA[', '').replace(']]>', '').strip()
+        img_match = re.search(r'<img.*?src="([^"]+)".*?>', desc)
+        thumbnail = img_match.group(1) if img_match else None
+        news_items.append({"title": title, "url": link, "publishTime": pub_date,
+                           "content": desc_clean[:200] + "...", "thumbnail": thumbnail,
+                           "category": classify(title + " " + desc_clean)})
+    return news_items
+
+def make_rss(count):
+    """RSS 2.0 feed shaped like the Piapro blog, with ~4 KB of HTML per post"""
+    paragraph = "<p>初音ミク「マジカルミライ」の最新情報をお届けします &amp; more news. " * 40 + "</p>"
+    items = []
+    for i in range(count):
+        items.append(
+            f"<item><title><![CDATA[新曲 #{i} & お知らせ]]></title>"
+            f"<link>https://blog.piapro.net/{i}</link>"
+            f"<pubDate>Thu, 27 Nov 2025 08:{i % 60:02d}:02 +0000</pubDate>"
+            f"<description><![CDATA[excerpt {i}]]></description>"
+            f"<content:encoded><![CDATA[<img src=\"https://example.com/{i}.jpg\" />{paragraph}]]></content:encoded>"
+            f"</item>"
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"><channel>'
+        "<title>bench</title>" + "".join(items) + "</channel></rss>"
+    ).encode("utf-8")
+
+def best_of(func, runs=3):
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def stream(data, max_items, chunk_size=16384):
+    parser = FeedParser(max_items)
+    for offset in range(0, len(data), chunk_size):
+        if parser.feed(data[offset:offset + chunk_size]):
+            break
+    return parser.close()
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000]
+    service = NewsService()
+
+    # Sanity check: both paths agree on the fields the UI shows
+    sample = make_rss(20)
+    old = regex_parse_piapro(sample.decode("utf-8"), service._classify_news)
+    new = service._piapro_news_items(parse_feed(sample))
+    for a, b in zip(old, new):
+        assert a["url"] == b["url"] and a["publishTime"] == b["publishTime"] and a["thumbnail"] == b["thumbnail"]
+        assert a["title"] == b["title"]
+
+    print(f"{'items':>6} {'size':>9} {'regex':>10} {'stream':>10} {'stream@30':>10}")
+    for count in sizes:
+        data = make_rss(count)
+        text = data.decode("utf-8")
+        regex_ms = best_of(lambda: regex_parse_piapro(text, service._classify_news))
+        full_ms = best_of(lambda: service._piapro_news_items(stream(data, None)))
+        capped_ms = best_of(lambda: service._piapro_news_items(stream(data, 30)))
+        print(f"{count:>6} {len(data) / 1024 / 1024:>7.1f}MB {regex_ms:>8.1f}ms {full_ms:>8.1f}ms {capped_ms:>8.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Compare the chat search index with a naive scan of every session on generated history.
+
+Usage: python bench_search.py [messages ...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from search_index import SearchIndex, query_terms
+from session_store import ChatSession, SqliteSessionStore
+
+PHRASES = [
+    "今天的演唱会太棒了", "初音ミクの新曲を聴きました", "マジカルミライのチケットが当たった",
+    "推荐一些初音未来的歌", "What songs did Miku sing at the concert?", "明天一起去看演唱会吧",
+    "这首歌的编曲很有意思", "ボカロPのおすすめを教えて", "I love the new module design",
+    "今天天气不错，适合出门散步", "晚饭吃什么好呢", "プロジェクトセカイのイベント始まったね",
+]
+QUERIES = ["演唱会", "初音", "ミク", "miku", "编曲", "不存在的词", "新曲 チケット"]
+SESSION_SIZE = 50
+
+def generate(store, username, count):
+    rng = random.Random(0)
+    for start in range(0, count, SESSION_SIZE):
+        session = ChatSession(id=f"s{start}", name=f"Chat {start}", created_at="2025-01-01T00:00:00",
+                              last_message_at="2025-01-01T00:00:00", message_count=0)
+        messages = [
+            {"role": "user" if i % 2 == 0 else "assistant",
+             "content": " ".join(rng.sample(PHRASES, 3)) + f" #{start + i}",
+             "timestamp": f"2025-01-01T00:00:{i:02d}"}
+            for i in range(min(SESSION_SIZE, count - start))
+        ]
+        session.messages = messages
+        store.import_sessions(username, [session])
+
+def naive_search(store, username, query):
+    """The only option before the index: load every session's messages and scan them"""
+    terms = query_terms(query)
+    hits = []
+    for session in store.load_sessions(username):
+        messages, _ = store.load_messages(username, session.id)
+        for message in messages:
+            text = message["content"].casefold()
+            if all(term in text for term in terms):
+                hits.append(message)
+    return hits
+
+def best_of(func, runs=3):
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    for count in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteSessionStore(os.path.join(tmp, "sessions.db"))
+            index = SearchIndex(os.path.join(tmp, "search.db"))
+            generate(store, "bench", count)
+
+            start = time.perf_counter()
+            index.backfill("bench", store.load_all_messages("bench"))
+            build_ms = (time.perf_counter() - start) * 1000
+            print(f"{count} messages, index built in {build_ms:.0f}ms")
+            print(f"{'query':>16} {'hits':>7} {'naive':>10} {'index':>10}")
+            for query in QUERIES:
+                expected = naive_search(store, "bench", query)
+                _, total = index.search("bench", query)
+                # The index also matches words by prefix, so it may find a superset
+                assert total >= len(expected), (query, total, len(expected))
+                naive_ms = best_of(lambda: naive_search(store, "bench", query))
+                index_ms = best_of(lambda: index.search("bench", query))
+                print(f"{query:>16} {total:>7} {naive_ms:>8.1f}ms {index_ms:>8.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+from cache_utils import SingleFlight
+from image_preprocess import ImagePreprocessor
+
+# Images sent in chat live with the sessions that reference them
+CHAT_IMAGE_DIR = os.path.join("sessions", "images")
+_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/gif": ".gif",
+               "image/bmp": ".bmp", "image/avif": ".avif"}
+
+class StoredImage:
+    def __init__(self, digest: str, path: str, content_type: str, description: Optional[str] = None):
+        self.hash = digest
+        self.path = path
+        self.content_type = content_type
+        self.description = description
+
+class ChatImageStore:
+    """Content-addressed store for images sent in chat, plus a description of each.
+
+    Uploads are keyed by the sha256 of the uploaded bytes, so a resent
+    screenshot is neither preprocessed nor stored twice. The first time an
+    image is seen the model is asked (in the background) for a description;
+    later turns carry that text instead of the pixels. Images are kept for
+    the chat history and never evicted; the index lives in
+    <image_dir>/index.json.
+    """
+
+    def __init__(self, describe: Callable[[str], Awaitable[Optional[str]]],
+                 preprocessor: Optional[ImagePreprocessor] = None, image_dir: str = CHAT_IMAGE_DIR):
+        # Called with a data URI; returns the description or None on failure
+        self.describe = describe
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        self.image_dir = image_dir
+        self.index_path = os.path.join(image_dir, "index.json")
+        # hash -> {"type", "size", "width", "height", "created", "description"?}
+        self._images: Dict[str, Dict] = {}
+        self._flight = SingleFlight()
+        self._describing: Dict[str, asyncio.Task] = {}
+        self.stats = {"hits": 0, "misses": 0, "descriptions": 0, "description_errors": 0, "description_reuses": 0}
+        os.makedirs(image_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._images = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Error loading chat image index: {e}")
+        self._images = {
+            digest: meta for digest, meta in self._images.items()
+            if os.path.exists(self._path(digest, meta["type"]))
+        }
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._images, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _path(self, digest: str, content_type: str) -> str:
+        return os.path.join(self.image_dir, digest[:2], digest + _EXTENSIONS.get(content_type, ""))
+
+    def get(self, digest: str) -> Optional[StoredImage]:
+        meta = self._images.get(digest)
+        if meta is None:
+            return None
+        return StoredImage(digest, self._path(digest, meta["type"]), meta["type"], meta.get("description"))
+
+    def _write(self, digest: str, data: bytes) -> Dict:
+        """Preprocess and persist a new image (blocking)"""
+        prepared = self.preprocessor.prepare(data)
+        path = self._path(digest, prepared.content_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(prepared.data)
+        os.replace(tmp_path, path)
+        return {"type": prepared.content_type, "size": len(prepared.data),
+                "width": prepared.width, "height": prepared.height, "created": time.time()}
+
+    async def _add(self, digest: str, data: bytes) -> Dict:
+        loop = asyncio.get_event_loop()
+        meta = await loop.run_in_executor(None, self._write, digest, data)
+        self._images[digest] = meta
+        self._save_index()
+        return meta
+
+    async def put(self, data: bytes) -> StoredImage:
+        """Store an uploaded image (shrunk for the model) unless it is already known.
+
+        Raises ValueError for files that are not usable images.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self._images:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            await self._flight.do(digest, lambda: self._add(digest, data))
+        image = self.get(digest)
+        if image.description is None:
+            self._schedule_description(image)
+        return image
+
+    async def data_uri(self, image: StoredImage) -> str:
+        """The stored (already shrunk) image inline, for the model"""
+        loop = asyncio.get_event_loop()
+
+        def read():
+            with open(image.path, "rb") as f:
+                return base64.b64encode(f.read()).decode("ascii")
+
+        return f"data:{image.content_type};base64,{await loop.run_in_executor(None, read)}"
+
+    def _schedule_description(self, image: StoredImage):
+        task = self._describing.get(image.hash)
+        if task and not task.done():
+            return
+        self._describing[image.hash] = asyncio.ensure_future(self._update_description(image))
+
+    async def _update_description(self, image: StoredImage):
+        try:
+            description = await self.describe(await self.data_uri(image))
+            if description:
+                self._images[image.hash]["description"] = description
+                self._save_index()
+                self.stats["descriptions"] += 1
+            else:
+                self.stats["description_errors"] += 1
+        except Exception as e:
+            self.stats["description_errors"] += 1
+            print(f"Error describing chat image {image.hash}: {e}")
+        finally:
+            self._describing.pop(image.hash, None)
+
+    def annotate_history(self, history: List[Dict]) -> List[Dict]:
+        """Prompt history where earlier images are replaced by their cached descriptions"""
+        annotated = []
+        for message in history:
+            digest = message.get("image")
+            if not digest:
+                annotated.append(message)
+                continue
+            description = self._images.get(digest, {}).get("description")
+            if description:
+                self.stats["description_reuses"] += 1
+                note = f"[Master shared an image: {description}]"
+            else:
+                note = "[Master shared an image]"
+            annotated.append({**message, "content": f"{message.get('content', '')}\n{note}".strip()})
+        return annotated
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "images": len(self._images),
+            "bytes": sum(meta["size"] for meta in self._images.values()),
+            "described": sum(1 for meta in self._images.values() if meta.get("description")),
+            "preprocess": self.preprocessor.get_stats(),
+        }
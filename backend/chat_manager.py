@@ -1,70 +1,111 @@
-import json
+import asyncio
 import os
 import uuid
 from datetime import datetime
-from typing import List, Optional, Dict
-from dataclasses import dataclass, asdict
+from typing import List, Optional, Dict, Tuple
 from llm_service import LLMService
+from context_window import select_history
+from title_queue import TitleQueue
+from session_cache import SessionCache, estimate_message_bytes, estimate_session_bytes
+from search_index import SearchIndex
+from session_store import (
+    ChatSession, SessionStore, SqliteSessionStore,
+    create_session_store, legacy_json_path, paginate_messages, read_legacy_json
+)
 
-@dataclass
-class ChatSession:
-    id: str
-    name: str
-    created_at: str
-    last_message_at: str
-    message_count: int
-    messages: List[Dict] = None
-    
-    def __post_init__(self):
-        if self.messages is None:
-            self.messages = []
+# Bounds for the per-user session cache
+SESSION_CACHE_USERS = int(os.getenv("SESSION_CACHE_USERS", "64"))
+SESSION_CACHE_MB = float(os.getenv("SESSION_CACHE_MB", "64"))
+
+# Prompt context assembled from stored history
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "40"))
+# Fold messages that fall out of the window into a rolling summary (extra LLM call)
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "0").lower() in ("1", "true", "yes")
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "10"))
+
+# Background session title generation
+TITLE_MIN_INTERVAL = float(os.getenv("TITLE_MIN_INTERVAL", "1"))
+TITLE_MAX_ATTEMPTS = int(os.getenv("TITLE_MAX_ATTEMPTS", "3"))
 
 class ChatManager:
-    def __init__(self, storage_dir: str = "sessions"):
+    def __init__(self, storage_dir: str = "sessions", llm_service: Optional[LLMService] = None,
+                 store: Optional[SessionStore] = None, search_index: Optional[SearchIndex] = None):
         self.storage_dir = storage_dir
-        self.sessions: Dict[str, ChatSession] = {}
-        self.llm_service = LLMService()
+        self.cache = SessionCache(SESSION_CACHE_USERS, int(SESSION_CACHE_MB * 1024 * 1024))
+        # Share the caller's service so all model calls go through one bounded pool
+        self.llm_service = llm_service or LLMService()
         # Create storage directory if it doesn't exist
         os.makedirs(self.storage_dir, exist_ok=True)
+        self.store = store or create_session_store(self.storage_dir)
+        self.search_index = search_index or SearchIndex(os.path.join(self.storage_dir, "search.db"))
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        self.titles = TitleQueue(self._generate_session_name, self._apply_session_name,
+                                 min_interval=TITLE_MIN_INTERVAL, max_attempts=TITLE_MAX_ATTEMPTS)
     
     def _get_user_storage_path(self, username: str) -> str:
-        """Get the storage path for a specific user"""
-        # Sanitize username for filename
-        safe_username = "".join(c for c in username if c.isalnum() or c in ('_', '-'))
-        return os.path.join(self.storage_dir, f"{safe_username}_sessions.json")
+        """Get the legacy JSON storage path for a specific user"""
+        return legacy_json_path(self.storage_dir, username)
     
-    def _load_sessions(self, username: str):
-        """Load sessions from user-specific JSON file"""
+    def _import_legacy_sessions(self, username: str):
+        """Copy a user's old JSON file into the SQLite store the first time they show up"""
+        if not isinstance(self.store, SqliteSessionStore) or self.store.is_imported(username):
+            return
         storage_path = self._get_user_storage_path(username)
-        self.sessions = {}  # Clear current sessions
-        
+        sessions = []
         if os.path.exists(storage_path):
             try:
-                with open(storage_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for session_data in data:
-                        session = ChatSession(**session_data)
-                        self.sessions[session.id] = session
+                sessions = read_legacy_json(storage_path)
             except Exception as e:
-                print(f"Error loading sessions for {username}: {e}")
-                self.sessions = {}
+                print(f"Error importing legacy sessions for {username}: {e}")
+                return
+        imported = self.store.import_sessions(username, sessions)
+        if imported:
+            print(f"Imported {imported} legacy sessions for {username}")
     
-    def _save_sessions(self, username: str):
-        """Save sessions to user-specific JSON file"""
+    def _load_sessions(self, username: str) -> Dict[str, ChatSession]:
+        """Get a user's sessions from the cache, loading them from the store on a miss"""
+        version = self.store.version(username)
+        sessions = self.cache.get(username, version)
+        if sessions is not None:
+            return sessions
+        
+        sessions = {}
         try:
-            storage_path = self._get_user_storage_path(username)
-            data = [asdict(session) for session in self.sessions.values()]
-            with open(storage_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self._import_legacy_sessions(username)
+            for session in self.store.load_sessions(username):
+                sessions[session.id] = session
+            version = self.store.version(username)
         except Exception as e:
-            print(f"Error saving sessions for {username}: {e}")
+            print(f"Error loading sessions for {username}: {e}")
+            return {}
+        self.cache.put(username, sessions, version)
+        return sessions
+    
+    def _owner_of(self, session_id: str) -> Optional[str]:
+        """Owner of a session: from the cache, or from the store after a restart or eviction"""
+        return self.cache.owner_of(session_id) or self.store.owner_of(session_id)
+
+    def _find_session(self, session_id: str, username: Optional[str] = None) -> Optional[ChatSession]:
+        """Look a session up in its owner's sessions"""
+        if username is None:
+            username = self._owner_of(session_id)
+            if username is None:
+                return None
+        return self._load_sessions(username).get(session_id)
+    
+    def _ensure_messages(self, username: str, session: ChatSession):
+        """Materialize the messages of a session that was loaded metadata-only"""
+        if session.messages_loaded:
+            return
+        session.messages, _ = self.store.load_messages(username, session.id)
+        session.messages_loaded = True
+        self.cache.add_bytes(username, sum(estimate_message_bytes(m) for m in session.messages))
     
     async def create_session(self, first_message: str, username: str) -> str:
-        """Create a new session and generate name based on first message"""
+        """Create a new session with a provisional name; the LLM title follows in the background"""
         session_id = str(uuid.uuid4())
-        
-        # Generate session name using LLM
-        session_name = await self._generate_session_name(first_message)
+        session_name = self._provisional_session_name(first_message)
         
         now = datetime.now().isoformat()
         session = ChatSession(
@@ -76,60 +117,190 @@ class ChatManager:
             messages=[]
         )
         
-        self.sessions[session_id] = session
-        self._save_sessions(username)
+        self._load_sessions(username)[session_id] = session
+        self.store.save_session(username, session)
+        self.cache.note_write(username, self.store.version(username), session,
+                              size_delta=estimate_session_bytes(session))
+        self.titles.enqueue(session_id, username, first_message)
         return session_id
     
-    async def _generate_session_name(self, first_message: str) -> str:
-        """Generate a concise session name using LLM"""
-        try:
-            prompt = f"Generate a very short title (3-5 words max) for a chat conversation that starts with: '{first_message[:100]}'. Only output the title, nothing else."
-            name = await self.llm_service.generate_session_name(prompt)
-            # Clean up the name
-            name = name.strip().strip('"').strip("'")
-            return name[:50]  # Limit length
-        except Exception as e:
-            print(f"Error generating session name: {e}")
+    def _provisional_session_name(self, first_message: str) -> str:
+        """Name shown until the generated title arrives: the start of the first message"""
+        text = " ".join(first_message.split())
+        if not text:
             return f"Chat {datetime.now().strftime('%m-%d %H:%M')}"
+        return text if len(text) <= 20 else text[:20] + "…"
+    
+    async def _generate_session_name(self, first_message: str) -> Optional[str]:
+        """Generate a concise session name using LLM (None if it failed)"""
+        prompt = f"Generate a very short title (3-5 words max) for a chat conversation that starts with: '{first_message[:100]}'. Only output the title, nothing else."
+        name = await self.llm_service.generate_session_name(prompt)
+        if not name:
+            return None
+        # Clean up the name
+        name = name.strip().strip('"').strip("'")
+        return name[:50] or None  # Limit length
+    
+    def _apply_session_name(self, session_id: str, username: str, name: str):
+        """Store a generated title once the background job finishes"""
+        session = self._find_session(session_id, username)
+        if session:
+            session.name = name
+            self.store.save_session(username, session)
+            self.cache.note_write(username, self.store.version(username))
+    
+    def is_title_pending(self, session_id: str) -> bool:
+        return self.titles.is_pending(session_id)
     
-    def get_session(self, session_id: str) -> Optional[ChatSession]:
+    def get_session(self, session_id: str, username: Optional[str] = None) -> Optional[ChatSession]:
         """Get a session by ID"""
-        return self.sessions.get(session_id)
+        return self._find_session(session_id, username)
     
     def list_sessions(self, username: str) -> List[ChatSession]:
         """List all sessions for a user, sorted by last message time"""
-        self._load_sessions(username)
-        sessions = list(self.sessions.values())
+        sessions = list(self._load_sessions(username).values())
         sessions.sort(key=lambda s: s.last_message_at, reverse=True)
         return sessions
     
     def delete_session(self, session_id: str, username: str) -> bool:
         """Delete a session"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
-            self._save_sessions(username)
+        sessions = self._load_sessions(username)
+        if session_id in sessions:
+            session = sessions.pop(session_id)
+            self.store.delete_session(username, session_id)
+            self.cache.note_write(username, self.store.version(username),
+                                  size_delta=-estimate_session_bytes(session), removed=session_id)
+            try:
+                self.search_index.delete_session(username, session_id)
+            except Exception as e:
+                print(f"Error removing {session_id} from the search index: {e}")
             return True
         return False
     
     def add_message(self, session_id: str, message: Dict, username: str):
         """Add a message to a session"""
-        session = self.sessions.get(session_id)
+        session = self._find_session(session_id, username)
         if session:
-            session.messages.append(message)
-            session.message_count = len(session.messages)
+            if session.messages_loaded:
+                session.messages.append(message)
+                session.message_count = len(session.messages)
+            else:
+                # Appending doesn't need the history in memory
+                session.message_count += 1
             session.last_message_at = datetime.now().isoformat()
-            self._save_sessions(username)
+            self.store.append_message(username, session, message)
+            self.cache.note_write(username, self.store.version(username),
+                                  size_delta=estimate_message_bytes(message) if session.messages_loaded else 0)
+            try:
+                self.search_index.add(username, session_id, session.message_count - 1, message)
+            except Exception as e:
+                # Search is best-effort; the message itself is already stored
+                print(f"Error indexing message in {session_id}: {e}")
     
-    def get_messages(self, session_id: str) -> List[Dict]:
-        """Get all messages for a session"""
-        session = self.sessions.get(session_id)
-        return session.messages if session else []
+    def get_messages(self, session_id: str, username: Optional[str] = None, limit: Optional[int] = None,
+                     before: Optional[str] = None, after: Optional[str] = None, offset: int = 0) -> List[Dict]:
+        """Get messages for a session (all of them, or a window, see get_message_page)"""
+        return self.get_message_page(session_id, username, limit, before, after, offset)[0]
+    
+    def get_message_page(self, session_id: str, username: Optional[str] = None, limit: Optional[int] = None,
+                         before: Optional[str] = None, after: Optional[str] = None,
+                         offset: int = 0) -> Tuple[List[Dict], bool]:
+        """Get a window of messages and whether more exist beyond it.
+        
+        Without `after` the window is the newest `limit` messages older than `before`;
+        with `after` it is the oldest `limit` messages newer than it.
+        """
+        if username is None:
+            username = self._owner_of(session_id)
+        session = self._find_session(session_id, username)
+        if not session:
+            return [], False
+        if session.messages_loaded:
+            return paginate_messages(session.messages, limit, before, after, offset)
+        if limit is None and before is None and after is None and offset == 0:
+            # Full history requested: keep it cached for the next fetch
+            self._ensure_messages(username, session)
+            return list(session.messages), False
+        return self.store.load_messages(username, session_id, limit, before, after, offset)
+    
+    async def search_messages(self, username: str, query: str, offset: int = 0,
+                              limit: int = 20) -> Tuple[List[Dict], int]:
+        """Full-text search over all of a user's sessions: (page of hits, total hits).
+        
+        The first search indexes the user's existing history in a worker thread;
+        after that the index is kept current by add_message.
+        """
+        sessions = self._load_sessions(username)
+        loop = asyncio.get_event_loop()
+        if not self.search_index.is_indexed(username):
+            messages = await loop.run_in_executor(None, self.store.load_all_messages, username)
+            await loop.run_in_executor(None, self.search_index.backfill, username, messages)
+        hits, total = await loop.run_in_executor(None, self.search_index.search, username, query, offset, limit)
+        for hit in hits:
+            session = sessions.get(hit["session_id"])
+            hit["session_name"] = session.name if session else None
+        return hits, total
     
     def rename_session(self, session_id: str, new_name: str, username: str) -> bool:
         """Rename a session"""
-        session = self.sessions.get(session_id)
+        session = self._find_session(session_id, username)
         if session:
+            # The user's choice wins over a title still being generated
+            self.titles.discard(session_id)
             session.name = new_name[:50]
-            self._save_sessions(username)
+            self.store.save_session(username, session)
+            self.cache.note_write(username, self.store.version(username))
             return True
         return False
+    
+    def build_context(self, session_id: str, username: str,
+                      token_budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[List[Dict], str]:
+        """Assemble prompt history for the next turn from the stored session.
+        
+        Returns (history, summary): the newest messages that fit in token_budget and
+        the rolling summary of older turns (empty unless CONTEXT_SUMMARY is on).
+        """
+        session = self._find_session(session_id, username)
+        if not session or session.message_count == 0:
+            return [], ""
+        
+        recent, _ = self.get_message_page(session_id, username, limit=CONTEXT_MAX_MESSAGES)
+        history = select_history(recent, token_budget)
+        window_start = session.message_count - len(history)
+        
+        if CONTEXT_SUMMARY and window_start - session.summary_upto >= CONTEXT_SUMMARY_BATCH:
+            self._schedule_summary(session, username, window_start)
+        return history, session.summary if window_start > 0 else ""
+    
+    def _schedule_summary(self, session: ChatSession, username: str, upto: int):
+        """Summarize messages [summary_upto, upto) in the background, one task per session"""
+        task = self._summary_tasks.get(session.id)
+        if task and not task.done():
+            return
+        self._summary_tasks[session.id] = asyncio.ensure_future(self._update_summary(session, username, upto))
+    
+    async def _update_summary(self, session: ChatSession, username: str, upto: int):
+        try:
+            start = session.summary_upto
+            older, _ = self.store.load_messages(
+                username, session.id, limit=upto - start, offset=session.message_count - upto
+            )
+            summary = await self.llm_service.summarize_conversation(session.summary, older)
+            if summary:
+                session.summary = summary
+                session.summary_upto = upto
+                self.store.save_session(username, session)
+                self.cache.note_write(username, self.store.version(username))
+        except Exception as e:
+            print(f"Error updating summary for {session.id}: {e}")
+        finally:
+            self._summary_tasks.pop(session.id, None)
+    
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
+    
+    def title_stats(self) -> dict:
+        return self.titles.stats()
+    
+    def search_stats(self) -> dict:
+        return self.search_index.get_stats()
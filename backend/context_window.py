@@ -0,0 +1,39 @@
+import re
+from typing import List, Dict
+
+# CJK ideographs, kana and hangul are roughly one token per character for Qwen
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+# Fixed cost of a message's role and separators
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: one per CJK character, one per ~4 other characters"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def select_history(messages: List[Dict], token_budget: int) -> List[Dict]:
+    """Keep the newest messages whose combined size fits in token_budget.
+
+    Messages are chronological; the result is too. Returns {"role", "content"}
+    pairs ready for LLMService, plus "image" (a chat image hash) where present.
+    """
+    selected = []
+    used = 0
+    for msg in reversed(messages):
+        content = str(msg.get("content", ""))
+        cost = estimate_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+        if used + cost > token_budget:
+            break
+        used += cost
+        entry = {"role": msg.get("role", "user"), "content": content}
+        if msg.get("image"):
+            entry["image"] = msg["image"]
+        selected.append(entry)
+    selected.reverse()
+    # The model expects history to open with a user turn
+    while selected and selected[0]["role"] != "user":
+        selected.pop(0)
+    return selected
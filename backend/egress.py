@@ -0,0 +1,190 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import httpx
+from http_client import HttpClient
+
+# Local proxies tried after (or instead of) a direct connection, comma separated
+EGRESS_PROXIES = os.getenv("EGRESS_PROXIES", "http://127.0.0.1:7897,http://127.0.0.1:7890,http://127.0.0.1:10809")
+# Seconds between background health probes
+EGRESS_PROBE_INTERVAL = float(os.getenv("EGRESS_PROBE_INTERVAL", "60"))
+EGRESS_PROBE_TIMEOUT = 3.0
+# Hosts are only probed while they carry real traffic: a request within this many seconds
+EGRESS_PROBE_IDLE = 600
+# Weight of the newest sample in the latency moving average
+LATENCY_ALPHA = 0.3
+# Statuses a proxy returns when it could not reach the upstream
+PROXY_FAILURE_STATUSES = {502, 503, 504}
+
+class _RouteHealth:
+    def __init__(self):
+        self.healthy: Optional[bool] = None
+        self.latency: Optional[float] = None
+        self.successes = 0
+        self.failures = 0
+        self.last_failure = 0.0
+
+    def record(self, ok: bool, latency: Optional[float] = None):
+        self.healthy = ok
+        if ok:
+            self.successes += 1
+            if latency is not None:
+                self.latency = latency if self.latency is None else (
+                    LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * self.latency
+                )
+        else:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+
+    def sort_key(self) -> Tuple:
+        # Healthy by latency, then untested, then failed ones (longest ago first)
+        if self.healthy:
+            return 0, self.latency or 0.0
+        if self.healthy is None:
+            return 1, 0.0
+        return 2, self.last_failure
+
+    def as_dict(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "successes": self.successes,
+            "failures": self.failures,
+        }
+
+class EgressManager:
+    """Chooses the outbound route (direct or one of the local proxies) per upstream host.
+
+    Health and latency are learned from real requests and from background
+    probes of registered URLs, whose hosts are probed only while they have
+    been used recently (headers only, the body is not read). Requests go through the best known route
+    first and fall over to the next on connection errors, so a blocked
+    direct route costs one timeout per probe interval instead of one per
+    request. It mirrors HttpClient's request/get/open_stream/stream, so
+    services can take either.
+    """
+
+    def __init__(self, http: HttpClient, proxies: Optional[List[str]] = None,
+                 probe_interval: float = EGRESS_PROBE_INTERVAL):
+        self.http = http
+        if proxies is None:
+            proxies = [p.strip() for p in EGRESS_PROXIES.split(",") if p.strip()]
+        # None is the direct route
+        self.routes: List[Optional[str]] = [None] + proxies
+        self.probe_interval = probe_interval
+        self._probe_urls: List[str] = []
+        # host -> route -> health
+        self._health: Dict[str, Dict[Optional[str], _RouteHealth]] = {}
+        # host -> monotonic time of the last real request
+        self._last_used: Dict[str, float] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def add_probe(self, url: str):
+        """Probe this URL's host on every route in the background"""
+        if url not in self._probe_urls:
+            self._probe_urls.append(url)
+
+    def _host_health(self, url: str) -> Dict[Optional[str], _RouteHealth]:
+        host = urlsplit(url).netloc
+        health = self._health.get(host)
+        if health is None:
+            health = self._health[host] = {route: _RouteHealth() for route in self.routes}
+        return health
+
+    def routes_for(self, url: str) -> List[Optional[str]]:
+        """Routes for a URL, best first"""
+        health = self._host_health(url)
+        # sorted() is stable, so untested routes keep the configured order
+        return sorted(self.routes, key=lambda route: health[route].sort_key())
+
+    async def _send(self, method: str, url: str, stream: bool, **kwargs) -> httpx.Response:
+        # Fail over between routes rather than retrying a dead one
+        kwargs.setdefault("retries", 0)
+        self._last_used[urlsplit(url).netloc] = time.monotonic()
+        health = self._host_health(url)
+        routes = self.routes_for(url)
+        last_error: Optional[Exception] = None
+        for index, route in enumerate(routes):
+            started = time.perf_counter()
+            try:
+                if stream:
+                    response = await self.http.open_stream(method, url, proxy=route, **kwargs)
+                else:
+                    response = await self.http.request(method, url, proxy=route, **kwargs)
+            except httpx.TransportError as e:
+                health[route].record(False)
+                last_error = e
+                continue
+            if route is not None and response.status_code in PROXY_FAILURE_STATUSES and index + 1 < len(routes):
+                health[route].record(False)
+                await response.aclose()
+                continue
+            health[route].record(True, time.perf_counter() - started)
+            return response
+        raise last_error or RuntimeError(f"No route to {url}")
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self._send(method, url, False, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def open_stream(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self._send(method, url, True, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        response = await self.open_stream(method, url, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def _probe(self, url: str, route: Optional[str]):
+        health = self._host_health(url)
+        started = time.perf_counter()
+        try:
+            # Only the status matters, so hang up once the headers arrive
+            response = await self.http.open_stream("GET", url, proxy=route, retries=0, timeout=EGRESS_PROBE_TIMEOUT)
+            await response.aclose()
+        except httpx.HTTPError:
+            health[route].record(False)
+            return
+        ok = response.status_code < 500
+        health[route].record(ok, time.perf_counter() - started if ok else None)
+
+    async def probe_all(self, idle: Optional[float] = EGRESS_PROBE_IDLE):
+        """Check registered URLs on every route concurrently, skipping hosts idle for over `idle` seconds"""
+        now = time.monotonic()
+        urls = [
+            url for url in self._probe_urls
+            if idle is None or now - self._last_used.get(urlsplit(url).netloc, -idle) < idle
+        ]
+        await asyncio.gather(*(self._probe(url, route) for url in urls for route in self.routes))
+
+    async def _probe_loop(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                print(f"Egress probe error: {e}")
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self):
+        """Begin background probing (call from the app lifespan)"""
+        if self._probe_urls and (self._probe_task is None or self._probe_task.done()):
+            self._probe_task = asyncio.ensure_future(self._probe_loop())
+
+    async def aclose(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+
+    def get_stats(self) -> dict:
+        return {
+            host: {route or "direct": h.as_dict() for route, h in health.items()}
+            for host, health in self._health.items()
+        }
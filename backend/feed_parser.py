@@ -0,0 +1,148 @@
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+CONTENT_NS = "{http://purl.org/rss/1.0/modules/content/}"
+
+def normalize_date(value: str) -> str:
+    """RFC 822 (RSS) or ISO 8601 (Atom) date -> 'YYYY-MM-DD HH:MM'; unparseable input is returned as-is"""
+    value = (value or "").strip()
+    if not value:
+        return ""
+    try:
+        return parsedate_to_datetime(value).strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError, IndexError):
+        pass
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).strftime("%Y-%m-%d %H:%M")
+    except ValueError:
+        return value
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self.images: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "img":
+            src = dict(attrs).get("src")
+            if src:
+                self.images.append(src)
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+def html_to_text(markup: str, max_chars: Optional[int] = None) -> Tuple[str, List[str]]:
+    """Strip tags from an HTML fragment, returning (text, image sources in order).
+
+    With max_chars, parsing stops once roughly that much text has been
+    collected, so long post bodies cost no more than their opening.
+    """
+    if not markup:
+        return "", []
+    extractor = _TextExtractor()
+    if max_chars is None:
+        extractor.feed(markup)
+    else:
+        # Markup is at least as long as its text, so feed slices of max_chars
+        step = max(max_chars, 256)
+        collected = 0
+        for start in range(0, len(markup), step):
+            extractor.feed(markup[start:start + step])
+            collected = sum(len(part) for part in extractor.parts)
+            if collected >= max_chars:
+                break
+    extractor.close()
+    text = "".join(extractor.parts).strip()
+    return (text if max_chars is None else text[:max_chars]), extractor.images
+
+class FeedParser:
+    """Incremental RSS 2.0 / Atom parser.
+
+    Feed it response chunks as they arrive; feed() returns True once max_items
+    entries have been read so the caller can stop downloading. Each item is a
+    dict with title, link, published (normalized), summary and content (raw
+    HTML strings, entities and CDATA already decoded).
+    """
+
+    def __init__(self, max_items: Optional[int] = None):
+        self.max_items = max_items
+        self.items: List[Dict] = []
+        self._parser = ET.XMLPullParser(events=("end",))
+        self._done = False
+
+    def feed(self, chunk: bytes) -> bool:
+        if self._done:
+            return True
+        try:
+            self._parser.feed(chunk)
+            self._collect()
+        except ET.ParseError as e:
+            # Keep whatever was parsed before the malformed part
+            print(f"Feed parse error: {e}")
+            self._done = True
+        return self._done
+
+    def close(self) -> List[Dict]:
+        if not self._done:
+            try:
+                self._parser.close()
+                self._collect()
+            except ET.ParseError as e:
+                print(f"Feed parse error: {e}")
+        return self.items
+
+    def _collect(self):
+        for _, elem in self._parser.read_events():
+            if self._done:
+                break
+            if elem.tag == "item":
+                self.items.append(self._rss_item(elem))
+            elif elem.tag == ATOM_NS + "entry":
+                self.items.append(self._atom_entry(elem))
+            else:
+                continue
+            # Drop the parsed subtree so memory stays flat on large feeds
+            elem.clear()
+            if self.max_items is not None and len(self.items) >= self.max_items:
+                self._done = True
+
+    @staticmethod
+    def _text(elem, tag: str) -> str:
+        child = elem.find(tag)
+        return (child.text or "").strip() if child is not None else ""
+
+    def _rss_item(self, elem) -> Dict:
+        return {
+            "title": self._text(elem, "title"),
+            "link": self._text(elem, "link"),
+            "published": normalize_date(self._text(elem, "pubDate")),
+            "summary": self._text(elem, "description"),
+            "content": self._text(elem, CONTENT_NS + "encoded"),
+        }
+
+    def _atom_entry(self, elem) -> Dict:
+        link = ""
+        for link_elem in elem.findall(ATOM_NS + "link"):
+            if link_elem.get("rel", "alternate") == "alternate":
+                link = link_elem.get("href", "")
+                break
+        return {
+            "title": self._text(elem, ATOM_NS + "title"),
+            "link": link,
+            "published": normalize_date(
+                self._text(elem, ATOM_NS + "published") or self._text(elem, ATOM_NS + "updated")
+            ),
+            "summary": self._text(elem, ATOM_NS + "summary"),
+            "content": self._text(elem, ATOM_NS + "content"),
+        }
+
+def parse_feed(data: bytes, max_items: Optional[int] = None) -> List[Dict]:
+    """Parse a complete feed body"""
+    parser = FeedParser(max_items)
+    parser.feed(data)
+    return parser.close()
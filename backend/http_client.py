@@ -0,0 +1,168 @@
+import asyncio
+import importlib.util
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+import httpx
+
+# Total seconds per request (connect, each read, pool wait) unless a call overrides it
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+# Extra attempts for idempotent requests on network errors and 502/503/504
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+# Idle connections kept open for reuse, across all hosts
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = 30.0
+
+# HTTP/2 needs the optional h2 package (pip install "httpx[http2]")
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+RETRY_STATUSES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+class _HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.latency_total = 0.0
+
+    def as_dict(self) -> dict:
+        answered = self.requests - self.errors
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "in_flight": self.in_flight,
+            "avg_headers_ms": round(self.latency_total / answered * 1000, 1) if answered else None,
+        }
+
+class HttpClient:
+    """Shared outbound HTTP layer.
+
+    Wraps one httpx.AsyncClient per egress proxy (None = direct). Each keeps
+    a keep-alive pool per origin, so repeated calls to bilibili, safebooru
+    or piapro skip DNS/TCP/TLS setup. Close it from the app lifespan.
+    """
+
+    def __init__(self, timeout: float = HTTP_TIMEOUT, connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 retries: int = HTTP_RETRIES, max_connections: int = HTTP_MAX_CONNECTIONS,
+                 max_keepalive: int = HTTP_MAX_KEEPALIVE):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.http2 = HTTP2_AVAILABLE
+        self._clients: Dict[Optional[str], httpx.AsyncClient] = {}
+        self._hosts: Dict[str, _HostStats] = {}
+
+    def client(self, proxy: Optional[str] = None) -> httpx.AsyncClient:
+        """The pooled client for a proxy URL, created on first use"""
+        client = self._clients.get(proxy)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=self.http2,
+                proxy=proxy,
+                headers={"User-Agent": BROWSER_USER_AGENT},
+                follow_redirects=True,
+            )
+            self._clients[proxy] = client
+        return client
+
+    async def _send(self, method: str, url: str, proxy: Optional[str], stream: bool,
+                    retries: Optional[int], **kwargs) -> httpx.Response:
+        client = self.client(proxy)
+        stats = self._hosts.setdefault(urlsplit(url).netloc, _HostStats())
+        attempts = 1 + (self.retries if retries is None else retries)
+        if method.upper() not in IDEMPOTENT_METHODS:
+            attempts = 1
+
+        for attempt in range(attempts):
+            if attempt:
+                stats.retries += 1
+                await asyncio.sleep(0.2 * 2 ** (attempt - 1))
+            request = client.build_request(method, url, **kwargs)
+            stats.requests += 1
+            stats.in_flight += 1
+            started = time.perf_counter()
+            try:
+                response = await client.send(request, stream=stream)
+            except httpx.TransportError:
+                stats.errors += 1
+                if attempt + 1 < attempts:
+                    continue
+                raise
+            finally:
+                stats.in_flight -= 1
+            stats.latency_total += time.perf_counter() - started
+            if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+                await response.aclose()
+                continue
+            return response
+
+    async def request(self, method: str, url: str, *, proxy: Optional[str] = None,
+                      retries: Optional[int] = None, **kwargs) -> httpx.Response:
+        """Send a request and read the whole body"""
+        return await self._send(method, url, proxy, False, retries, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def open_stream(self, method: str, url: str, *, proxy: Optional[str] = None,
+                          retries: Optional[int] = None, **kwargs) -> httpx.Response:
+        """Send a request and return as soon as the headers arrive; the caller must aclose() it"""
+        return await self._send(method, url, proxy, True, retries, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """`async with http.stream(...) as response:` - the connection is released on exit"""
+        response = await self.open_stream(method, url, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    @staticmethod
+    def _pool_stats(client: httpx.AsyncClient) -> dict:
+        # httpx has no public pool API; read httpcore's connection list defensively
+        # (a proxied client routes everything through its mounted proxy transport)
+        connections = []
+        for transport in [client._transport, *client._mounts.values()]:
+            pool = getattr(transport, "_pool", None)
+            connections.extend(getattr(pool, "connections", []))
+        return {
+            "open": len(connections),
+            "idle": sum(1 for c in connections if c.is_idle()),
+        }
+
+    def get_stats(self) -> dict:
+        return {
+            "http2_enabled": self.http2,
+            "pools": {proxy or "direct": self._pool_stats(c) for proxy, c in self._clients.items()},
+            "hosts": {host: s.as_dict() for host, s in self._hosts.items()},
+        }
+
+async def iter_and_close(response: httpx.Response, chunk_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """Relay a streamed body (e.g. into a StreamingResponse), releasing the connection at the end"""
+    try:
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+    finally:
+        await response.aclose()
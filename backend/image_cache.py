@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+from typing import Dict, Optional
+from cache_utils import SingleFlight
+from http_client import HttpClient, BROWSER_USER_AGENT
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails are optional; originals are served without Pillow
+    Image = None
+
+# Disk budget for proxied images and their thumbnails
+IMAGE_CACHE_MB = float(os.getenv("IMAGE_CACHE_MB", "200"))
+IMAGE_CACHE_DIR = os.path.join("cache", "images")
+# Upstream images larger than this are refused
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+# Browsers may reuse a proxied image this long without asking again
+IMAGE_MAX_AGE = 7 * 24 * 3600
+# Requested widths are rounded up to one of these so thumbnails are shared
+THUMBNAIL_WIDTHS = (96, 192, 384, 768)
+# Music covers are shown at most 96 CSS px wide (the player disc); 2x for HiDPI screens
+COVER_THUMB_WIDTH = 192
+# The only types served back; SVG (and anything else a browser could run as a document) is refused
+RASTER_IMAGE_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp", "image/avif", "image/bmp")
+# Sent with every served image so a mislabelled file can't run script on the API origin
+IMAGE_RESPONSE_HEADERS = {
+    "Content-Security-Policy": "default-src 'none'; sandbox",
+    "X-Content-Type-Options": "nosniff",
+}
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """Content type from the file's magic bytes, None if it is not a known raster image format"""
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return None
+
+def thumbnail_width(width: int) -> int:
+    for allowed in THUMBNAIL_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return THUMBNAIL_WIDTHS[-1]
+
+class CachedImage:
+    def __init__(self, path: str, content_type: str, etag: str):
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+
+class ImageCache:
+    """Content-addressed disk cache for the image proxy.
+
+    Upstream URLs map to the sha256 of their body, so the same cover under
+    different URLs is stored once. Thumbnails are stored next to the original
+    as <hash>_<width>. Least recently used files are evicted beyond the
+    size budget; the index lives in <cache_dir>/index.json.
+    """
+
+    def __init__(self, http: HttpClient, cache_dir: str = IMAGE_CACHE_DIR,
+                 max_bytes: int = int(IMAGE_CACHE_MB * 1024 * 1024)):
+        self.http = http
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        # url -> {"hash", "type"}
+        self._urls: Dict[str, Dict] = {}
+        # blob name -> {"type", "size", "last_access"}
+        self._blobs: Dict[str, Dict] = {}
+        self._total = 0
+        self._flight = SingleFlight()
+        self.headers = {
+            "User-Agent": BROWSER_USER_AGENT,
+            "Referer": "https://www.bilibili.com/"
+        }
+        self.stats = {"hits": 0, "misses": 0, "thumbnails": 0, "evictions": 0, "errors": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+                self._urls = index.get("urls", {})
+                self._blobs = index.get("blobs", {})
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Error loading image cache index: {e}")
+        self._blobs = {
+            name: meta for name, meta in self._blobs.items()
+            if meta["type"] in RASTER_IMAGE_TYPES and os.path.exists(self._path(name))
+        }
+        self._urls = {url: meta for url, meta in self._urls.items() if meta["hash"] in self._blobs}
+        self._total = sum(meta["size"] for meta in self._blobs.values())
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"urls": self._urls, "blobs": self._blobs}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name[:2], name)
+
+    def _store(self, name: str, data: bytes, content_type: str):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if name not in self._blobs:
+            self._total += len(data)
+        self._blobs[name] = {"type": content_type, "size": len(data), "last_access": time.time()}
+
+    def _touch(self, name: str) -> CachedImage:
+        meta = self._blobs[name]
+        meta["last_access"] = time.time()
+        return CachedImage(self._path(name), meta["type"], f'"{name}"')
+
+    async def _fetch(self, url: str) -> str:
+        """Download an image into the store; returns its content hash"""
+        self.stats["misses"] += 1
+        # Streamed, so an oversized body is refused without downloading it all
+        async with self.http.stream("GET", url, headers=self.headers) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Upstream returned HTTP {response.status_code}")
+            declared = response.headers.get("content-length", "")
+            if declared.isdigit() and int(declared) > IMAGE_MAX_BYTES:
+                raise ValueError("Image too large")
+            chunks, size = [], 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise ValueError("Image too large")
+                chunks.append(chunk)
+        data = b"".join(chunks)
+        content_type = sniff_image_type(data)
+        if content_type is None:
+            upstream_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            if upstream_type not in RASTER_IMAGE_TYPES:
+                raise ValueError(f"Unsupported image type ({upstream_type or 'unknown type'})")
+            content_type = upstream_type
+
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self._blobs:
+            self._store(digest, data, content_type)
+        self._urls[url] = {"hash": digest, "type": content_type}
+        self._evict(keep=digest)
+        self._save_index()
+        return digest
+
+    @staticmethod
+    def _resize(data: bytes, width: int) -> Optional[tuple]:
+        """(bytes, content type) of a downscaled copy, or None if the original is already small enough"""
+        with Image.open(io.BytesIO(data)) as img:
+            if img.width <= width:
+                return None
+            height = max(1, round(img.height * width / img.width))
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            img = img.convert("RGBA" if has_alpha else "RGB").resize((width, height), Image.LANCZOS)
+            out = io.BytesIO()
+            if has_alpha:
+                img.save(out, format="PNG", optimize=True)
+                return out.getvalue(), "image/png"
+            img.save(out, format="JPEG", quality=85, optimize=True)
+            return out.getvalue(), "image/jpeg"
+
+    async def _thumbnail(self, digest: str, width: int) -> str:
+        """Blob name of the thumbnail (or the original if it can't or needn't be resized)"""
+        name = f"{digest}_{width}"
+        if name in self._blobs:
+            return name
+        with open(self._path(digest), "rb") as f:
+            data = f.read()
+        loop = asyncio.get_event_loop()
+        try:
+            resized = await loop.run_in_executor(None, self._resize, data, width)
+        except Exception as e:
+            print(f"Thumbnail error ({digest}): {e}")
+            resized = None
+        if resized is None:
+            return digest
+        self._store(name, resized[0], resized[1])
+        self.stats["thumbnails"] += 1
+        self._evict(keep=name)
+        self._save_index()
+        return name
+
+    async def _original(self, url: str) -> str:
+        """Content hash of the upstream image, downloading it on a miss"""
+        meta = self._urls.get(url)
+        if meta is not None and meta["hash"] in self._blobs:
+            self.stats["hits"] += 1
+            return meta["hash"]
+        try:
+            return await self._flight.do(url, lambda: self._fetch(url))
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+
+    def _forget(self, name: str):
+        """Drop a blob whose file is gone from the index"""
+        meta = self._blobs.pop(name, None)
+        if meta is not None:
+            self._total -= meta["size"]
+        self._urls = {url: meta for url, meta in self._urls.items() if meta["hash"] in self._blobs}
+
+    async def get(self, url: str, width: Optional[int] = None) -> CachedImage:
+        """Cached image for an upstream URL, downscaled to about `width` pixels if Pillow is installed"""
+        for attempt in range(2):
+            digest = await self._original(url)
+            try:
+                meta = self._blobs.get(digest)
+                if meta is None:
+                    raise FileNotFoundError(digest)
+                name = digest
+                if width and Image is not None and meta["type"] != "image/gif":
+                    size = thumbnail_width(width)
+                    name = await self._flight.do((digest, size), lambda: self._thumbnail(digest, size))
+                return self._touch(name)
+            except FileNotFoundError:
+                # Evicted by a concurrent request since the lookup: download it again
+                self._forget(digest)
+                if attempt:
+                    raise
+
+    def _evict(self, keep: str):
+        if self._total <= self.max_bytes:
+            return
+        for name, meta in sorted(self._blobs.items(), key=lambda item: item[1]["last_access"]):
+            if self._total <= self.max_bytes:
+                break
+            if name == keep or name == keep.split("_")[0]:
+                continue
+            try:
+                os.remove(self._path(name))
+            except OSError as e:
+                print(f"Error evicting cached image {name}: {e}")
+            self._total -= meta["size"]
+            del self._blobs[name]
+            self.stats["evictions"] += 1
+        # URLs whose original is gone are fetched again on the next request
+        self._urls = {url: meta for url, meta in self._urls.items() if meta["hash"] in self._blobs}
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "files": len(self._blobs),
+            "bytes": self._total,
+            "thumbnails_enabled": Image is not None,
+        }
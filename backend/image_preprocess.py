@@ -0,0 +1,132 @@
+import base64
+import io
+import os
+import time
+from typing import Dict, Optional
+from image_cache import sniff_image_type
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Without Pillow images are sent as uploaded (format still checked)
+    Image = None
+    ImageOps = None
+
+# Pixel budget for chat images; Qwen VL downsamples anything larger (1280 * 28 * 28 by default)
+CHAT_IMAGE_MAX_PIXELS = int(os.getenv("CHAT_IMAGE_MAX_PIXELS", str(1280 * 28 * 28)))
+CHAT_IMAGE_QUALITY = int(os.getenv("CHAT_IMAGE_QUALITY", "85"))
+# Largest image accepted with a chat message
+CHAT_IMAGE_MAX_BYTES = 20 * 1024 * 1024
+# Formats the model accepts directly; others are re-encoded even when small enough
+MODEL_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp")
+# Metadata that forces a re-encode so it is not sent along (location, camera, comments)
+STRIPPED_INFO_KEYS = ("exif", "xmp", "comment", "photoshop")
+STAGES = ("detect", "decode", "resize", "encode")
+
+class PreparedImage:
+    def __init__(self, data: bytes, content_type: str, width: Optional[int] = None,
+                 height: Optional[int] = None):
+        self.data = data
+        self.content_type = content_type
+        self.width = width
+        self.height = height
+
+    def data_uri(self) -> str:
+        """Inline form accepted by DashScope, so no temp file or OSS upload is needed"""
+        return f"data:{self.content_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+class ImagePreprocessor:
+    """Shrinks uploaded chat images to what the vision model actually uses.
+
+    The real format is sniffed from the bytes, JPEGs are decoded at reduced
+    size where possible, the image is scaled into the model's pixel budget
+    and re-encoded without EXIF/XMP metadata. Images that are already small,
+    metadata-free and in a model format pass through untouched.
+    """
+
+    def __init__(self, max_pixels: int = CHAT_IMAGE_MAX_PIXELS, quality: int = CHAT_IMAGE_QUALITY):
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.stats = {"images": 0, "reencoded": 0, "bytes_in": 0, "bytes_out": 0}
+        # stage -> [total ms, runs]; resize and encode only run for re-encoded images
+        self._stage_ms: Dict[str, list] = {stage: [0.0, 0] for stage in STAGES}
+
+    def _target_size(self, width: int, height: int):
+        if width * height <= self.max_pixels:
+            return width, height
+        scale = (self.max_pixels / (width * height)) ** 0.5
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def prepare(self, data: bytes) -> PreparedImage:
+        """Validate and shrink one image (blocking; run it in an executor)"""
+        if len(data) > CHAT_IMAGE_MAX_BYTES:
+            raise ValueError(f"Image exceeds {CHAT_IMAGE_MAX_BYTES // (1024 * 1024)} MB")
+        timings = {}
+        started = time.perf_counter()
+        content_type = sniff_image_type(data)
+        timings["detect"] = time.perf_counter()
+        if content_type is None:
+            raise ValueError("Unsupported image format")
+
+        if Image is None:
+            prepared = PreparedImage(data, content_type)
+        else:
+            prepared = self._process(data, content_type, timings)
+
+        self.stats["images"] += 1
+        self.stats["bytes_in"] += len(data)
+        self.stats["bytes_out"] += len(prepared.data)
+        previous = started
+        for stage in STAGES:
+            if stage in timings:
+                self._stage_ms[stage][0] += (timings[stage] - previous) * 1000
+                self._stage_ms[stage][1] += 1
+                previous = timings[stage]
+        return prepared
+
+    def _process(self, data: bytes, content_type: str, timings: Dict[str, float]) -> PreparedImage:
+        try:
+            img = Image.open(io.BytesIO(data))
+            width, height = img.size
+            target = self._target_size(width, height)
+            if img.format == "JPEG" and target != (width, height):
+                # Let the JPEG decoder skip detail we'd throw away (DCT scaling)
+                img.draft("RGB", target)
+            # Animated images: the model only looks at the first frame
+            img.load()
+        except Exception as e:
+            raise ValueError(f"Cannot decode image: {e}")
+        timings["decode"] = time.perf_counter()
+
+        has_metadata = any(key in img.info for key in STRIPPED_INFO_KEYS) or bool(img.getexif())
+        if (target == (width, height) and not has_metadata and content_type in MODEL_IMAGE_TYPES
+                and not getattr(img, "is_animated", False)):
+            return PreparedImage(data, content_type, width, height)
+
+        # Phone photos are stored sideways with an EXIF rotation flag; apply it before dropping EXIF
+        img = ImageOps.exif_transpose(img)
+        target = self._target_size(*img.size)
+        if img.size != target:
+            img = img.resize(target, Image.LANCZOS)
+        timings["resize"] = time.perf_counter()
+
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        out = io.BytesIO()
+        if has_alpha:
+            img.save(out, format="PNG", optimize=True)
+            content_type = "image/png"
+        else:
+            img.convert("RGB").save(out, format="JPEG", quality=self.quality, optimize=True)
+            content_type = "image/jpeg"
+        timings["encode"] = time.perf_counter()
+        self.stats["reencoded"] += 1
+        return PreparedImage(out.getvalue(), content_type, *img.size)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "resize_enabled": Image is not None,
+            "avg_stage_ms": {
+                stage: round(total / runs, 2) if runs else None
+                for stage, (total, runs) in self._stage_ms.items()
+            },
+        }
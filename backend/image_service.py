@@ -1,94 +1,162 @@
-import requests
+import asyncio
+import os
 import random
 import sys
-from typing import Optional, Dict
+from collections import deque
+from typing import Optional, Dict, List, Union
+from http_client import HttpClient
+from egress import EgressManager
+
+# Filtered image records kept ready to serve
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", "60"))
+# Seconds a request waits for the pool's first fill before falling back
+IMAGE_POOL_WAIT = float(os.getenv("IMAGE_POOL_WAIT", "3"))
+# Images not repeated until this many others have been shown
+RECENT_IMAGES = 200
+# Posts requested per Safebooru call (API maximum is 100)
+BATCH_SIZE = 100
+
+FALLBACK_IMAGE = {
+    "image_url": "/miku_avatar.png",
+    "source_url": "https://github.com/ReinerBRO/MikuChat",
+    "tags": ["network_error", "offline_mode", "miku_cute"],
+    "width": 500,
+    "height": 500,
+    "rating": "safe"
+}
 
 class ImageService:
-    def __init__(self):
+    """Random Miku images from Safebooru, served from a prefetched pool.
+
+    Requests pop a pre-filtered record from the pool; a background task
+    refills it from a random result page whenever it runs low. Recently
+    shown ids are skipped, and when upstream is unreachable the recently
+    shown images are reused instead of failing.
+    """
+
+    def __init__(self, http: Optional[Union[HttpClient, EgressManager]] = None, pool_size: int = IMAGE_POOL_SIZE):
         self.safebooru_url = "https://safebooru.org/index.php"
-        
-    def get_random_miku_image(self) -> Optional[Dict]:
+        # With an EgressManager, requests go out over the healthiest route (direct or proxy)
+        self.http = http or EgressManager(HttpClient())
+        self.pool_size = pool_size
+        self._pool: deque = deque()
+        self._recent_ids: deque = deque(maxlen=RECENT_IMAGES)
+        # Records already shown, reused when upstream is down
+        self._shown: deque = deque(maxlen=RECENT_IMAGES)
+        self._refill_task: Optional[asyncio.Task] = None
+        # Highest result page known to have posts; shrinks when a page comes back empty
+        self._max_page = 50
+        self.stats = {"served": 0, "pool_misses": 0, "fallbacks": 0, "refills": 0, "refill_errors": 0}
+
+    def start_prefetch(self):
+        """Fill the pool in the background (call from the app lifespan)"""
+        self._ensure_refill()
+
+    def _ensure_refill(self):
+        if len(self._pool) > self.pool_size // 3:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    @staticmethod
+    def _to_record(image: Dict) -> Dict:
+        # Construct the full image URL
+        if 'file_url' in image:
+            image_url = image['file_url']
+        else:
+            image_url = f"https://safebooru.org/images/{image.get('directory', '')}/{image.get('image', '')}"
+
+        return {
+            "id": image.get('id'),
+            "image_url": image_url,
+            "source_url": f"https://safebooru.org/index.php?page=post&s=view&id={image.get('id', '')}",
+            "tags": image.get('tags', '').split()[:10],
+            "width": image.get('width', 0),
+            "height": image.get('height', 0),
+            "rating": image.get('rating', 'safe')
+        }
+
+    async def _fetch_batch(self, page: int) -> Optional[List[Dict]]:
+        """One page of filtered records; None if upstream is unreachable"""
+        params = {
+            "page": "dapi",
+            "s": "post",
+            "q": "index",
+            "tags": "hatsune_miku rating:safe",
+            "limit": BATCH_SIZE,
+            "pid": page,
+            "json": 1
+        }
+
+        try:
+            response = await self.http.get(self.safebooru_url, params=params, timeout=5)
+            if response.status_code != 200:
+                sys.stderr.write(f"Safebooru failed with status {response.status_code}\n")
+                return None
+            # An out-of-range page comes back as an empty body
+            images = response.json() if response.content.strip() else []
+        except Exception as e:
+            sys.stderr.write(f"Safebooru error: {str(e)}\n")
+            return None
+
+        # Filter out images with 'demon' in tags
+        return [
+            self._to_record(img) for img in images
+            if 'demon' not in img.get('tags', '').lower()
+        ]
+
+    async def _refill(self):
+        self.stats["refills"] += 1
+        while len(self._pool) < self.pool_size:
+            page = random.randint(0, self._max_page)
+            records = await self._fetch_batch(page)
+            if records is None:
+                self.stats["refill_errors"] += 1
+                sys.stderr.write("Safebooru unreachable; serving from the image pool.\n")
+                return
+            if not records and page > 0:
+                # Past the last page: search lower from now on
+                self._max_page = max(0, page - 1)
+                continue
+
+            random.shuffle(records)
+            known = set(self._recent_ids) | {r["id"] for r in self._pool}
+            added = 0
+            for record in records:
+                if record["id"] not in known:
+                    self._pool.append(record)
+                    known.add(record["id"])
+                    added += 1
+            if added == 0:
+                # Nothing new on this page (tiny result set); stop instead of spinning
+                return
+
+    async def get_random_miku_image(self) -> Optional[Dict]:
         """
-        Fetch a random Hatsune Miku image from Safebooru
+        A random Hatsune Miku image from the prefetched pool
         Returns dict with image_url, source_url, and tags
         """
-        proxies_list = [
-            None, # Try direct connection first
-            {'http': 'http://127.0.0.1:7897', 'https': 'http://127.0.0.1:7897'},
-            {'http': 'http://127.0.0.1:7890', 'https': 'http://127.0.0.1:7890'},
-            {'http': 'http://127.0.0.1:10809', 'https': 'http://127.0.0.1:10809'}, # v2rayN default
-        ]
+        if not self._pool:
+            self.stats["pool_misses"] += 1
+            self._ensure_refill()
+            # Cold start: give the first fill a moment, but don't wait on slow routes
+            await asyncio.wait({self._refill_task}, timeout=IMAGE_POOL_WAIT)
 
-        for proxy in proxies_list:
-            try:
-                proxy_name = proxy['http'] if proxy else "Direct"
-                sys.stderr.write(f"Trying connection via {proxy_name}...\n")
-                sys.stderr.flush()
-                
-                params = {
-                    "page": "dapi",
-                    "s": "post",
-                    "q": "index",
-                    "tags": "hatsune_miku rating:safe",
-                    "limit": 20,
-                    "json": 1
-                }
-                
-                response = requests.get(
-                    self.safebooru_url, 
-                    params=params, 
-                    timeout=5,
-                    proxies=proxy
-                )
-                
-                if response.status_code != 200:
-                    sys.stderr.write(f"Failed with status {response.status_code}\n")
-                    continue
-                    
-                images = response.json()
-                if not images:
-                    continue
-                
-                # Filter out images with 'demon' in tags
-                filtered_images = [
-                    img for img in images 
-                    if 'demon' not in img.get('tags', '').lower()
-                ]
-                
-                if not filtered_images:
-                    sys.stderr.write("No images after filtering 'demon' tags\n")
-                    continue
-                
-                # Randomly select one image from filtered list
-                image = random.choice(filtered_images)
-                
-                # Construct the full image URL
-                if 'file_url' in image:
-                    image_url = image['file_url']
-                else:
-                    image_url = f"https://safebooru.org/images/{image.get('directory', '')}/{image.get('image', '')}"
-                
-                result = {
-                    "image_url": image_url,
-                    "source_url": f"https://safebooru.org/index.php?page=post&s=view&id={image.get('id', '')}",
-                    "tags": image.get('tags', '').split()[:10],
-                    "width": image.get('width', 0),
-                    "height": image.get('height', 0),
-                    "rating": image.get('rating', 'safe')
-                }
-                sys.stderr.write(f"Success via {proxy_name}\n")
-                return result
-
-            except Exception as e:
-                sys.stderr.write(f"Error via {proxy_name}: {str(e)}\n")
-                continue
-        
-        sys.stderr.write("All connection attempts failed. Using fallback.\n")
-        return {
-            "image_url": "/miku_avatar.png",
-            "source_url": "https://github.com/ReinerBRO/MikuChat",
-            "tags": ["network_error", "offline_mode", "miku_cute"],
-            "width": 500,
-            "height": 500,
-            "rating": "safe"
-        }
+        if self._pool:
+            record = self._pool.popleft()
+            self._recent_ids.append(record["id"])
+            self._shown.append(record)
+        elif self._shown:
+            # Upstream is slow or down: repeat something already shown
+            self.stats["fallbacks"] += 1
+            record = random.choice(self._shown)
+        else:
+            self.stats["fallbacks"] += 1
+            return dict(FALLBACK_IMAGE)
+
+        self.stats["served"] += 1
+        self._ensure_refill()
+        return {key: value for key, value in record.items() if key != "id"}
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "pool": len(self._pool), "max_page": self._max_page}
@@ -1,9 +1,15 @@
 import os
 import dashscope
-from dashscope import MultiModalConversation
-from typing import Optional
-import tempfile
+from typing import Callable, Optional, AsyncIterator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import threading
+import time
 from dotenv import load_dotenv
+from response_cache import ResponseCache
+from model_router import ModelRouter, adapt_messages, response_text, sdk_call, sdk_kwargs, should_fall_back
 
 # Load environment variables
 load_dotenv()
@@ -11,9 +17,52 @@ load_dotenv()
 # Configure API Key
 dashscope.api_key = os.getenv("DASHSCOPE_API_KEY")
 
+# Maximum number of model calls running at the same time
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+# Seconds to wait for a reply (or for the next chunk of a streamed reply)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+class LLMStreamError(Exception):
+    """A streamed reply failed; any text already yielded is incomplete"""
+
+class _Slot:
+    """One unit of the concurrency limit, held by a model call.
+
+    It is released once the call is over and none of its jobs is still
+    running: a blocking SDK call that timed out can't be interrupted, so its
+    thread keeps the slot until it actually returns.
+    """
+
+    def __init__(self, release: Callable[[], None]):
+        self._release = release
+        self.jobs = 0
+        self.finished = False
+
+    def job_done(self):
+        self.jobs -= 1
+        self._maybe_release()
+
+    def finish(self):
+        self.finished = True
+        self._maybe_release()
+
+    def _maybe_release(self):
+        if self.finished and self.jobs == 0 and self._release is not None:
+            release, self._release = self._release, None
+            release()
+
 class LLMService:
-    def __init__(self):
-        self.model = "qwen-vl-max"
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT,
+                 response_cache: Optional[ResponseCache] = None, router: Optional[ModelRouter] = None):
+        # Which model serves each task (vision/chat/utility), with fallbacks
+        self.router = router or ModelRouter()
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        # The DashScope SDK is blocking, so calls run on a dedicated bounded pool;
+        # spare threads let a fallback attempt start while a timed-out call is still running
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency * 2, thread_name_prefix="llm")
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
         self.system_prompt = (
             "You are Hatsune Miku (初音ミク), the virtual singer. "
             "You are cheerful, energetic, and love music. "
@@ -21,9 +70,145 @@ class LLMService:
             "You are helpful and kind to your Master (the user). "
             "Keep your responses concise and engaging."
         )
+        # Recent time-to-first-token samples (ms) for streamed replies
+        self.ttft_samples = deque(maxlen=200)
+        # Replies to repeated prompts (see RESPONSE_CACHE); a no-op unless enabled
+        self.responses = response_cache or ResponseCache()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the running server loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _acquire_slot(self) -> _Slot:
+        await self._get_semaphore().acquire()
+        self.in_flight += 1
+        return _Slot(self._release_slot)
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _submit(self, slot: _Slot, func, *args):
+        """Queue a blocking SDK function on the LLM pool as one of the slot's jobs.
+
+        Returns (future set when a worker starts it, future of its result).
+        """
+        loop = asyncio.get_event_loop()
+        running = loop.create_future()
+
+        def job():
+            loop.call_soon_threadsafe(lambda: running.done() or running.set_result(None))
+            return func(*args)
+
+        slot.jobs += 1
+        future = self._executor.submit(job)
+        future.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(slot.job_done))
+        return running, future
+
+    async def _run_blocking(self, slot: _Slot, func, *args, timing: Optional[dict] = None):
+        """Run a blocking SDK function on the LLM pool with the per-call timeout.
 
-    async def generate_session_name(self, prompt: str) -> str:
-        """Generate a session name based on the first message"""
+        The timeout counts from when a worker picks the job up, not while it
+        waits for a thread; that wait is added to timing["queued"] (seconds).
+        """
+        submitted = time.perf_counter()
+        running, future = self._submit(slot, func, *args)
+        try:
+            await running
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        if timing is not None:
+            timing["queued"] = timing.get("queued", 0.0) + time.perf_counter() - submitted
+        result = asyncio.wrap_future(future)
+        # Consume the outcome even if nobody waits for it any more
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())
+        done, _ = await asyncio.wait({result}, timeout=self.timeout)
+        if not done:
+            # Left running; the slot is given back when it returns
+            raise asyncio.TimeoutError()
+        return result.result()
+
+    async def _call(self, task: str, messages: list[dict]):
+        """Non-streaming model call, bounded by the concurrency limit: (model that answered, response).
+        
+        Tries the task's models in order, moving on when one times out or is
+        throttled; the last model's outcome is returned (or raised) as is.
+        """
+        models = self.router.models_for(task)
+        slot = await self._acquire_slot()
+        try:
+            for index, model in enumerate(models):
+                last = index == len(models) - 1
+                started = time.perf_counter()
+                timing = {}
+                try:
+                    response = await self._run_blocking(slot, partial(
+                        sdk_call(model), model=model, messages=adapt_messages(model, messages), **sdk_kwargs(model)
+                    ), timing=timing)
+                except asyncio.TimeoutError:
+                    self.router.record(model, started, ok=False, timed_out=True, fell_back=not last,
+                                       queued=timing.get("queued", 0.0))
+                    if last:
+                        raise
+                    continue
+                fall_back = response.status_code != 200 and should_fall_back(response) and not last
+                self.router.record(model, started, ok=response.status_code == 200, fell_back=fall_back,
+                                   queued=timing.get("queued", 0.0))
+                if not fall_back:
+                    return model, response
+        finally:
+            slot.finish()
+
+    async def _open_stream(self, slot: _Slot, task: str, messages: list[dict]):
+        """Start a streamed call: (model, chunk generator, first chunk or None, lock), with the same fallback as _call.
+        
+        A model can only be swapped before its first chunk; after that the reply is committed.
+        """
+        models = self.router.models_for(task)
+        for index, model in enumerate(models):
+            last = index == len(models) - 1
+            started = time.perf_counter()
+            timing = {}
+            responses = None
+            lock = threading.Lock()
+            try:
+                responses = await self._run_blocking(slot, partial(
+                    sdk_call(model), model=model, messages=adapt_messages(model, messages),
+                    stream=True, incremental_output=True, **sdk_kwargs(model)
+                ), timing=timing)
+                first = await self._run_blocking(slot, self._next_chunk, responses, lock, timing=timing)
+            except asyncio.TimeoutError:
+                self.router.record(model, started, ok=False, timed_out=True, fell_back=not last,
+                                   queued=timing.get("queued", 0.0))
+                if responses is not None and hasattr(responses, "close"):
+                    self._submit(slot, self._close_stream, responses, lock)
+                if last:
+                    raise
+                continue
+            ok = first is None or first.status_code == 200
+            fall_back = not ok and should_fall_back(first) and not last
+            self.router.record(model, started, ok=ok, fell_back=fall_back, queued=timing.get("queued", 0.0))
+            if not fall_back:
+                return model, responses, first, lock
+            if hasattr(responses, "close"):
+                self._submit(slot, self._close_stream, responses, lock)
+
+    @staticmethod
+    def _next_chunk(responses, lock: threading.Lock):
+        with lock:
+            return next(responses, None)
+
+    @staticmethod
+    def _close_stream(responses, lock: threading.Lock):
+        # Waits for any in-flight chunk read, then closes the upstream connection
+        with lock:
+            responses.close()
+
+    async def generate_session_name(self, prompt: str) -> Optional[str]:
+        """Generate a session name based on the first message (None on failure)"""
         messages = [
             {
                 "role": "user",
@@ -32,23 +217,28 @@ class LLMService:
         ]
         
         try:
-            response = MultiModalConversation.call(model=self.model, messages=messages)
+            _, response = await self._call("utility", messages)
             if response.status_code == 200:
-                return response.output.choices[0].message.content[0]["text"]
+                return response_text(response)
             else:
-                return "New Chat"
+                return None
+        except asyncio.TimeoutError:
+            print("Error generating session name: timed out")
+            return None
         except Exception as e:
             print(f"Error generating session name: {e}")
-            return "New Chat"
+            return None
 
-    async def generate_response(self, text: str, image_data: Optional[bytes] = None, history: list[dict] = []) -> str:
-        """
-        Generates a response from Qwen VL.
-        """
+    def _build_messages(self, text: str, image: Optional[str], history: list[dict],
+                        summary: Optional[str] = None) -> list[dict]:
+        """Build the DashScope message list: system prompt, history, then the user turn"""
+        system_prompt = self.system_prompt
+        if summary:
+            system_prompt += f"\n\nSummary of the earlier conversation with Master: {summary}"
         messages = [
             {
                 "role": "system",
-                "content": [{"text": self.system_prompt}]
+                "content": [{"text": system_prompt}]
             }
         ]
 
@@ -61,34 +251,164 @@ class LLMService:
             })
 
         user_content = [{"text": text}]
-        temp_file_path = None
+        if image:
+            # Inline data URI; a file:// path would make the SDK upload it to OSS first
+            user_content.append({"image": image})
+
+        messages.append({
+            "role": "user",
+            "content": user_content
+        })
+        return messages
 
+    async def describe_image(self, image: str) -> Optional[str]:
+        """Describe an image (URL or data URI) so later turns can refer to it as text"""
+        prompt = (
+            "Describe this image so it can be discussed later without seeing it: "
+            "the main subjects, any visible text (verbatim), setting, colors and style. "
+            "Answer with the description only, in at most 120 words."
+        )
         try:
-            if image_data:
-                # Save bytes to a temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-                    temp_file.write(image_data)
-                    temp_file_path = temp_file.name
-                
-                # Add image to content (using local file path)
-                user_content.append({"image": f"file://{temp_file_path}"})
+            _, response = await self._call(
+                "vision", [{"role": "user", "content": [{"image": image}, {"text": prompt}]}]
+            )
+            if response.status_code == 200:
+                return response_text(response).strip()
+            print(f"Error describing image: {response.code} - {response.message}")
+        except asyncio.TimeoutError:
+            print("Error describing image: timed out")
+        except Exception as e:
+            print(f"Error describing image: {e}")
+        return None
 
-            messages.append({
-                "role": "user",
-                "content": user_content
-            })
+    async def summarize_conversation(self, previous_summary: str, messages: list[dict]) -> Optional[str]:
+        """Fold older messages into the rolling conversation summary"""
+        transcript = "\n".join(
+            f"{'Master' if msg['role'] == 'user' else 'Miku'}: {msg['content']}" for msg in messages
+        )
+        prompt = (
+            "Update the summary of a chat between Master and Miku. "
+            "Keep names, facts, preferences and open questions; drop small talk. "
+            "Answer with the new summary only, in at most 150 words, in the conversation's language.\n\n"
+            f"Current summary: {previous_summary or '(none)'}\n\n"
+            f"New messages:\n{transcript}"
+        )
+        try:
+            _, response = await self._call("utility", [{"role": "user", "content": [{"text": prompt}]}])
+            if response.status_code == 200:
+                return response_text(response).strip()
+            print(f"Error summarizing conversation: {response.code} - {response.message}")
+        except asyncio.TimeoutError:
+            print("Error summarizing conversation: timed out")
+        except Exception as e:
+            print(f"Error summarizing conversation: {e}")
+        return None
+
+    async def generate_response(self, text: str, image: Optional[str] = None, history: list[dict] = [],
+                                summary: Optional[str] = None) -> str:
+        """
+        Generates a response from Qwen VL. `image` is a URL or data URI.
+        """
+        task = "vision" if image else "chat"
+        primary = self.router.models_for(task)[0]
+        cache_key = self.responses.key(primary, text, history, summary, has_image=bool(image))
+        cached = self.responses.get(cache_key)
+        if cached is not None:
+            return cached
 
-            response = MultiModalConversation.call(model=self.model, messages=messages)
+        try:
+            messages = self._build_messages(text, image, history, summary)
+            model, response = await self._call(task, messages)
 
             if response.status_code == 200:
-                return response.output.choices[0].message.content[0]["text"]
+                reply = response_text(response)
+                # The key names the first-choice model; a fallback model's reply isn't stored under it
+                if model == primary:
+                    self.responses.put(cache_key, reply)
+                return reply
             else:
                 return f"Error: {response.code} - {response.message}"
 
+        except asyncio.TimeoutError:
+            return f"Error: the model did not reply within {self.timeout:g} seconds"
+
         except Exception as e:
             return f"An error occurred: {str(e)}"
-        
+
+    async def stream_response(self, text: str, image: Optional[str] = None, history: list[dict] = [],
+                              summary: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Streams a response from Qwen VL, yielding text deltas as they arrive.
+        Raises LLMStreamError on model errors and timeouts.
+        """
+        task = "vision" if image else "chat"
+        primary = self.router.models_for(task)[0]
+        cache_key = self.responses.key(primary, text, history, summary, has_image=bool(image))
+        cached = self.responses.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        started = time.perf_counter()
+        first_token = True
+        responses = None
+        parts = []
+        lock = None
+        slot = await self._acquire_slot()
+        try:
+            messages = self._build_messages(text, image, history, summary)
+            model, responses, response, lock = await self._open_stream(slot, task, messages)
+
+            while True:
+                if response is None:
+                    # Finished normally: the complete reply may be reused (if the first-choice model gave it)
+                    if model == primary:
+                        self.responses.put(cache_key, "".join(parts))
+                    break
+
+                if response.status_code != 200:
+                    raise LLMStreamError(f"{response.code} - {response.message}")
+
+                delta = response_text(response)
+                if delta:
+                    if first_token:
+                        first_token = False
+                        self.ttft_samples.append((time.perf_counter() - started) * 1000)
+                    parts.append(delta)
+                    yield delta
+
+                # The SDK returns a blocking generator, pull each chunk off the event loop
+                response = await self._run_blocking(slot, self._next_chunk, responses, lock)
+
+        except asyncio.TimeoutError:
+            raise LLMStreamError(f"the model did not reply within {self.timeout:g} seconds")
+
+        except LLMStreamError:
+            raise
+
+        except Exception as e:
+            raise LLMStreamError(str(e)) from e
+
         finally:
-            # Clean up temp file
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+            # Stop the upstream generation if we finished early, timed out or the client went away
+            if responses is not None and hasattr(responses, "close"):
+                self._submit(slot, self._close_stream, responses, lock)
+            slot.finish()
+
+    def get_metrics(self) -> dict:
+        """Concurrency, time-to-first-token and per-model statistics"""
+        samples = sorted(self.ttft_samples)
+        metrics = {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "ttft_samples": len(samples),
+            "models": self.router.get_stats()
+        }
+        if not samples:
+            return metrics
+        return {
+            **metrics,
+            "ttft_avg_ms": round(sum(samples) / len(samples), 1),
+            "ttft_p50_ms": round(samples[len(samples) // 2], 1),
+            "ttft_p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1)
+        }
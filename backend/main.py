@@ -1,19 +1,54 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Response
 from pydantic import BaseModel
 from typing import Optional, List
+from contextlib import asynccontextmanager
 import json
 import os
-import yt_dlp
+import time
 import asyncio
-from llm_service import LLMService
+from llm_service import LLMService, LLMStreamError
 from chat_manager import ChatManager, ChatSession
 from image_service import ImageService
 from news_service import NewsService
+from http_client import HttpClient, BROWSER_USER_AGENT
+from egress import EgressManager
+from stream_proxy import proxy_stream, audio_media_type, UpstreamStatusError
+from stream_resolver import StreamResolver
+from audio_cache import AudioCache
+from music_search import MusicSearch
+from image_cache import ImageCache, IMAGE_MAX_AGE, IMAGE_RESPONSE_HEADERS, COVER_THUMB_WIDTH
+from music_library import MusicLibrary, AUDIO_EXTENSIONS, COVER_EXTENSIONS
+from uploads import (
+    BodySizeLimitMiddleware, ResumableUploads, safe_filename, receive_upload, commit, discard,
+    UPLOAD_MAX_BYTES, COVER_MAX_BYTES, RESUMABLE_MAX_CHUNK
+)
+from image_preprocess import CHAT_IMAGE_MAX_BYTES
+from chat_images import ChatImageStore
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build (or catch up) the music library index before serving
+    await music_library.refresh(force=True)
+    egress.start()
+    image_service.start_prefetch()
+    yield
+    await egress.aclose()
+    await audio_cache.aclose()
+    # Close pooled upstream connections on shutdown
+    await http_client.aclose()
+
+app = FastAPI(title="MikuChat API", description="Backend for MikuChat WebUI", lifespan=lifespan)
 
-app = FastAPI(title="MikuChat API", description="Backend for MikuChat WebUI")
+# Refuse oversized uploads before the body is read (added first so CORS headers still apply)
+app.add_middleware(BodySizeLimitMiddleware, limits={
+    "/api/music/upload": UPLOAD_MAX_BYTES + COVER_MAX_BYTES + 64 * 1024,
+    "/api/music/upload/session": RESUMABLE_MAX_CHUNK,
+    # Covers /api/chat/stream too: one image plus the form fields
+    "/api/chat": CHAT_IMAGE_MAX_BYTES + 1024 * 1024,
+})
 
 # CORS Configuration
 origins = [
@@ -33,10 +68,23 @@ app.add_middleware(
 os.makedirs("music", exist_ok=True)
 app.mount("/music", StaticFiles(directory="music"), name="music")
 
+http_client = HttpClient()
+# Routes integrations that may be blocked on a direct connection through the healthiest proxy
+egress = EgressManager(http_client)
+egress.add_probe("https://safebooru.org/index.php?page=dapi&s=post&q=index&limit=1&json=1")
+egress.add_probe("https://news.google.com/rss?hl=zh-CN&gl=CN&ceid=CN:zh-Hans")
+egress.add_probe("https://blog.piapro.net/feed")
 llm_service = LLMService()
-chat_manager = ChatManager()
-image_service = ImageService()
-news_service = NewsService()
+chat_manager = ChatManager(llm_service=llm_service)
+chat_images = ChatImageStore(describe=llm_service.describe_image)
+image_service = ImageService(http=egress)
+news_service = NewsService(http=egress)
+stream_resolver = StreamResolver()
+audio_cache = AudioCache(http_client)
+music_search = MusicSearch(egress)
+image_cache = ImageCache(http_client)
+music_library = MusicLibrary()
+resumable_uploads = ResumableUploads()
 
 USER_CONFIG_FILE = "user_config.json"
 
@@ -79,194 +127,207 @@ from urllib.parse import quote
 
 # Music Endpoints
 @app.get("/api/music")
-async def list_music():
-    """List available music files"""
+async def list_music(
+    q: Optional[str] = None,
+    sort: str = Query("name", pattern="^(name|title|artist|album|duration|size|added)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    page: int = Query(1, ge=1),
+    limit: Optional[int] = Query(None, ge=1, le=500)
+):
+    """List available music files from the library index.
+    
+    Without `limit` every local track is returned (plus cached online tracks);
+    with it, `page` selects a page of `limit` tracks. `q` filters by file name or tags.
+    """
+    await music_library.refresh()
+    offset = (page - 1) * limit if limit else 0
+    tracks, total = music_library.query(q, sort, order == "desc", offset, limit)
+    
     files = []
-    if os.path.exists("music"):
-        for file in os.listdir("music"):
-            if file.endswith((".mp3", ".wav", ".ogg", ".mp4", ".m4a", ".flac")):
-                # Check for cover image with same name
-                base_name = os.path.splitext(file)[0]
-                cover_url = None
-                for ext in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
-                    if os.path.exists(os.path.join("music", base_name + ext)):
-                        cover_url = f"/music/{quote(base_name + ext)}"
-                        break
-                
-                files.append({
-                    "name": file,
-                    "url": f"/music/{quote(file)}",
-                    "type": "local",
-                    "cover": cover_url
-                })
-    return {"music": files}
+    for track in tracks:
+        files.append({
+            "name": track["name"],
+            "url": f"/music/{quote(track['name'])}",
+            "type": "local",
+            "cover": f"/music/{quote(track['cover'])}" if track.get("cover") else None,
+            "size": track["size"],
+            "duration": track.get("duration"),
+            "title": track.get("title"),
+            "artist": track.get("artist"),
+            "album": track.get("album")
+        })
+    if limit is None and not q:
+        # Online tracks that were played often enough to be kept on disk
+        for track in audio_cache.list_cached():
+            thumbnail = track.get("thumbnail")
+            files.append({
+                "name": track["title"],
+                "url": f"/music/cache/{quote(track['file'])}",
+                "type": "cached",
+                "id": track["id"],
+                "cover": f"http://localhost:8000/api/proxy/image?url={quote(thumbnail, safe='')}&w={COVER_THUMB_WIDTH}" if thumbnail else None
+            })
+            total += 1
+    return {"music": files, "total": total, "page": page, "has_more": limit is not None and offset + limit < total}
 
 @app.post("/api/music/upload")
 async def upload_music(file: UploadFile = File(...), cover: Optional[UploadFile] = File(None)):
     """Upload music file and optional cover"""
     try:
         # Validate music file
-        allowed_audio = {".mp3", ".wav", ".ogg", ".mp4", ".m4a", ".flac"}
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext not in allowed_audio:
-            return {"error": f"Invalid audio format. Allowed: {', '.join(allowed_audio)}"}
+        filename = safe_filename(file.filename)
+        file_ext = os.path.splitext(filename)[1].lower()
+        if file_ext not in AUDIO_EXTENSIONS:
+            return {"error": f"Invalid audio format. Allowed: {', '.join(AUDIO_EXTENSIONS)}"}
         
-        # Save music file
-        music_path = os.path.join("music", file.filename)
-        with open(music_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-            
-        # Save cover if provided
-        if cover:
-            allowed_images = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
-            cover_ext = os.path.splitext(cover.filename)[1].lower()
-            if cover_ext in allowed_images:
-                # Use same basename as music file
-                base_name = os.path.splitext(file.filename)[0]
-                cover_path = os.path.join("music", base_name + cover_ext)
-                with open(cover_path, "wb") as f:
-                    content = await cover.read()
-                    f.write(content)
+        # Stream both files to temp files first, so a rejected cover leaves nothing behind
+        temp_path, size, digest = await receive_upload(file, UPLOAD_MAX_BYTES)
+        cover_temp = None
+        cover_ext = os.path.splitext(cover.filename)[1].lower() if cover and cover.filename else None
+        if cover_ext in COVER_EXTENSIONS:
+            try:
+                cover_temp, _, _ = await receive_upload(cover, COVER_MAX_BYTES)
+            except BaseException:
+                discard(temp_path)
+                raise
+
+        # Then move them into place
+        duplicate = await music_library.find_duplicate(size, digest)
+        if duplicate:
+            discard(temp_path)
+        else:
+            commit(temp_path, os.path.join("music", filename))
+        if cover_temp:
+            # Use same basename as the stored music file
+            base_name = os.path.splitext(duplicate or filename)[0]
+            commit(cover_temp, os.path.join("music", base_name + cover_ext))
         
-        return {"success": True, "message": "Upload successful"}
+        # Overwriting an existing file doesn't change the directory mtime, so rescan explicitly
+        await music_library.refresh(force=True)
+        if duplicate:
+            return {"success": True, "duplicate": True, "name": duplicate,
+                    "message": f"Already in the library as {duplicate}"}
+        music_library.remember_hash(filename, digest)
+        return {"success": True, "name": filename, "message": "Upload successful"}
+    except HTTPException as e:
+        return JSONResponse({"error": e.detail}, status_code=e.status_code)
     except Exception as e:
         print(f"Upload error: {e}")
         return {"error": str(e)}
 
+# Resumable uploads: create -> PUT chunks at the reported offset -> complete
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+
+@app.post("/api/music/upload/session")
+async def create_upload_session(request: UploadSessionRequest):
+    """Start a resumable upload of `size` bytes"""
+    filename = safe_filename(request.filename)
+    if os.path.splitext(filename)[1].lower() not in AUDIO_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid audio format. Allowed: {', '.join(AUDIO_EXTENSIONS)}")
+    return resumable_uploads.create(filename, request.size)
+
+@app.get("/api/music/upload/session/{upload_id}")
+async def get_upload_session(upload_id: str):
+    """Bytes received so far; resume by PUTting from this offset"""
+    return resumable_uploads.status(upload_id)
+
+@app.put("/api/music/upload/session/{upload_id}")
+async def put_upload_chunk(upload_id: str, request: Request, offset: int = Query(..., ge=0)):
+    """Append the raw request body at `offset`"""
+    return await resumable_uploads.append(upload_id, offset, request)
+
+@app.post("/api/music/upload/session/{upload_id}/complete")
+async def complete_upload_session(upload_id: str):
+    """Move a fully received upload into the library"""
+    temp_path, filename, size, digest = await resumable_uploads.finish(upload_id)
+    duplicate = await music_library.find_duplicate(size, digest)
+    if duplicate:
+        discard(temp_path)
+        return {"success": True, "duplicate": True, "name": duplicate,
+                "message": f"Already in the library as {duplicate}"}
+    commit(temp_path, os.path.join("music", filename))
+    await music_library.refresh(force=True)
+    music_library.remember_hash(filename, digest)
+    return {"success": True, "name": filename, "message": "Upload successful"}
+
+@app.delete("/api/music/upload/session/{upload_id}")
+async def abort_upload_session(upload_id: str):
+    resumable_uploads.abort(upload_id)
+    return {"success": True}
+
 @app.get("/api/proxy/image")
-async def proxy_image(url: str):
-    """Proxy image to bypass Referer check"""
-    import requests
-    from fastapi.responses import StreamingResponse
-    
+async def proxy_image(request: Request, url: str, w: Optional[int] = Query(None, ge=16, le=2048)):
+    """Proxy image to bypass Referer check, served from the disk cache; `w` asks for a thumbnail"""
     if not url:
         return {"error": "No URL provided"}
+    if not url.startswith(("http://", "https://")):
+        return JSONResponse({"error": "Unsupported URL"}, status_code=400)
         
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Referer": "https://www.bilibili.com/"
-        }
-        
-        def iterfile():
-            with requests.get(url, headers=headers, stream=True) as r:
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-                    
-        return StreamingResponse(iterfile(), media_type="image/jpeg")
+        image = await image_cache.get(url, w)
     except Exception as e:
         print(f"Proxy error: {e}")
-        return {"error": str(e)}
+        return JSONResponse({"error": str(e)}, status_code=502)
+    
+    headers = {"ETag": image.etag, "Cache-Control": f"public, max-age={IMAGE_MAX_AGE}", **IMAGE_RESPONSE_HEADERS}
+    if request.headers.get("if-none-match") == image.etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(image.path, media_type=image.content_type, headers=headers)
 
 @app.get("/api/music/search")
-async def search_music(q: str):
-    """Search for music on Bilibili using official API"""
-    import requests
-    
-    # Append "初音未来" to search query if not present
-    search_keyword = q
-    if "初音" not in q and "miku" not in q.lower():
-        search_keyword = f"{q} 初音未来"
-    
+async def search_music(request: Request, q: str, page: int = Query(1, ge=1, le=50)):
+    """Search for music on Bilibili using official API (cached per normalized query and page)"""
     try:
-        # Bilibili Search API
-        url = "https://api.bilibili.com/x/web-interface/search/type"
-        params = {
-            "search_type": "video",
-            "keyword": search_keyword,
-            "page": 1,
-            "page_size": 10
-        }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Referer": "https://www.bilibili.com/",
-            "Cookie": "buvid3=infoc;"
-        }
-        
-        # Run in executor to avoid blocking
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, lambda: requests.get(url, params=params, headers=headers))
-        
-        if response.status_code != 200:
-            print(f"Bilibili API Error: Status {response.status_code}")
-            print(f"Response: {response.text[:200]}")
-            return {"results": []}
-            
-        try:
-            data = response.json()
-        except Exception as e:
-            print(f"JSON Decode Error: {e}")
-            print(f"Raw Response: {response.text[:200]}")
-            return {"results": []}
-        
-        results = []
-        if data['code'] == 0 and 'data' in data and 'result' in data['data']:
-            video_list = data['data']['result']
-            for video in video_list:
-                # Filter out non-video items just in case
-                if video.get('type') != 'video':
-                    continue
-                
-                # Construct cover URL
-                cover_url = video.get('pic', '')
-                if cover_url.startswith('//'):
-                    cover_url = 'https:' + cover_url
-                
-                # Use proxy for cover
-                proxied_cover = f"http://localhost:8000/api/proxy/image?url={cover_url}" if cover_url else None
-                    
-                results.append({
-                    "id": video['bvid'],
-                    "title": video['title'].replace('<em class="keyword">', '').replace('</em>', ''), # Clean highlight tags
-                    "duration": video.get('duration', '0'), # Format is usually "MM:SS" or seconds? API returns "MM:SS" string often
-                    "uploader": video.get('author', 'Unknown'),
-                    "type": "online",
-                    "cover": proxied_cover
-                })
-                
-        return {"results": results}
+        result = await music_search.search(q, page)
     except Exception as e:
         print(f"Search error: {e}")
-        return {"results": []}
+        result = None
+    if result is None:
+        return {"results": [], "page": page, "has_more": False}
+    
+    # Let the browser reuse the page for as long as the server would
+    headers = {"ETag": result["etag"], "Cache-Control": f"public, max-age={result['max_age']}"}
+    if request.headers.get("if-none-match") == result["etag"]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(result["payload"], headers=headers)
 
 @app.get("/api/music/stream/{video_id}")
-async def stream_music(video_id: str):
-    """Get streaming URL for a video"""
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        # 'cookiesfrombrowser': ('chrome', ) # Removed to avoid DB lock error
+async def stream_music(video_id: str, request: Request):
+    """Proxy the audio of a video; Range requests are passed through so seeking works"""
+    # Proxy the stream to bypass Referer check
+    # Bilibili requires Referer header
+    headers = {
+        "User-Agent": BROWSER_USER_AGENT,
+        "Referer": "https://www.bilibili.com/"
     }
     
+    # Only a request from the start counts as a play, not a seek
+    new_play = request.headers.get("range", "bytes=0-").startswith("bytes=0-")
+    cached = audio_cache.lookup(video_id, count_play=new_play)
+    if cached:
+        # FileResponse answers Range requests itself
+        return FileResponse(cached["path"], media_type=audio_media_type(cached.get("ext")))
+    
     try:
-        loop = asyncio.get_event_loop()
-        # Construct Bilibili URL if it looks like a BV ID
-        if video_id.startswith('BV'):
-            url_to_extract = f"https://www.bilibili.com/video/{video_id}"
-        else:
-            url_to_extract = video_id
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await loop.run_in_executor(None, lambda: ydl.extract_info(url_to_extract, download=False))
-            url = info['url']
-            
-            # Proxy the stream to bypass Referer check
-            import requests
-            from fastapi.responses import StreamingResponse
-            
-            # Bilibili requires Referer header
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Referer": "https://www.bilibili.com/"
-            }
-            
-            def iterfile():
-                with requests.get(url, headers=headers, stream=True) as r:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        yield chunk
-                        
-            return StreamingResponse(iterfile(), media_type="audio/mp4")
+        # Resolved CDN URLs are cached, so seeks don't re-run yt-dlp
+        stream = await stream_resolver.resolve(video_id)
+        if new_play:
+            audio_cache.record_play(video_id, stream, headers)
+        try:
+            return await proxy_stream(request, http_client, stream.url, headers, stream.ext)
+        except UpstreamStatusError as e:
+            if e.status_code not in (403, 410):
+                raise
+            # Signed URL expired or was revoked early: resolve again and retry once
+            stream = await stream_resolver.resolve(video_id, stale_url=stream.url)
+            return await proxy_stream(request, http_client, stream.url, headers, stream.ext)
+    except UpstreamStatusError as e:
+        print(f"Stream error: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Stream error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -276,11 +337,12 @@ async def stream_music(video_id: str):
 async def create_session(first_message: str = Form(...), username: str = Form(...)):
     """Create a new chat session"""
     session_id = await chat_manager.create_session(first_message, username)
-    session = chat_manager.get_session(session_id)
+    session = chat_manager.get_session(session_id, username)
     return {
         "session_id": session_id,
         "name": session.name,
-        "created_at": session.created_at
+        "created_at": session.created_at,
+        "title_pending": chat_manager.is_title_pending(session_id)
     }
 
 @app.get("/api/sessions")
@@ -294,12 +356,28 @@ async def list_sessions(username: str):
                 "name": s.name,
                 "created_at": s.created_at,
                 "last_message_at": s.last_message_at,
-                "message_count": s.message_count
+                "message_count": s.message_count,
+                "title_pending": chat_manager.is_title_pending(s.id)
             }
             for s in sessions
         ]
     }
 
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str, username: Optional[str] = None):
+    """Get session metadata; poll this until title_pending is false to pick up the generated name"""
+    session = chat_manager.get_session(session_id, username)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {
+        "id": session.id,
+        "name": session.name,
+        "created_at": session.created_at,
+        "last_message_at": session.last_message_at,
+        "message_count": session.message_count,
+        "title_pending": chat_manager.is_title_pending(session.id)
+    }
+
 @app.delete("/api/sessions/{session_id}")
 async def delete_session(session_id: str, username: str):
     """Delete a chat session"""
@@ -313,22 +391,47 @@ async def rename_session(session_id: str, request: RenameRequest, username: str
     return {"success": success}
 
 @app.get("/api/sessions/{session_id}/messages")
-async def get_session_messages(session_id: str):
-    """Get all messages for a session"""
-    messages = chat_manager.get_messages(session_id)
-    return {"messages": messages}
+async def get_session_messages(
+    session_id: str,
+    username: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    offset: int = Query(0, ge=0)
+):
+    """Get messages for a session.
+    
+    Without `limit` the whole history is returned. With `limit`, returns the newest
+    messages older than `before` (or, with `after`, the oldest messages newer than it).
+    `next_before`/`next_after` are the cursors for the following page.
+    """
+    messages, has_more = chat_manager.get_message_page(session_id, username, limit, before, after, offset)
+    result = {"messages": messages, "has_more": has_more}
+    if has_more and messages:
+        if after is not None:
+            result["next_after"] = messages[-1].get("timestamp")
+        else:
+            result["next_before"] = messages[0].get("timestamp")
+    return result
 
-# Chat Endpoint
-@app.post("/api/chat")
-async def chat(
-    text: str = Form(...),
-    username: str = Form(...),
-    session_id: Optional[str] = Form(None),
-    image: Optional[UploadFile] = File(None),
-    history: str = Form("[]")
+@app.get("/api/search")
+async def search_messages(
+    q: str,
+    username: str,
+    page: int = Query(1, ge=1),
+    limit: int = Query(20, ge=1, le=100)
 ):
-    import json
+    """Full-text search across all of a user's sessions.
     
+    Hits are ranked by relevance; `highlights` are [start, end) ranges of the
+    matched terms within `snippet`.
+    """
+    hits, total = await chat_manager.search_messages(username, q, (page - 1) * limit, limit)
+    return {"results": hits, "total": total, "page": page, "has_more": page * limit < total}
+
+# Chat Endpoint
+async def _resolve_chat_session(text: str, username: str, session_id: Optional[str]):
+    """Return (session_id, username), creating a new session if none was given"""
     # If no session_id, create a new session
     if not session_id:
         # Try to get username from config, default to "User"
@@ -341,44 +444,145 @@ async def chat(
             except:
                 pass
         session_id = await chat_manager.create_session(text, username)
-    
-    image_data = None
-    if image:
-        image_data = await image.read()
-    
-    try:
-        history_list = json.loads(history)
-    except json.JSONDecodeError:
-        history_list = []
-    
-    # Generate response
-    response = await llm_service.generate_response(text, image_data, history_list)
-    
-    # Save messages to session
+    return session_id, username
+
+def _save_chat_turn(session_id: str, username: str, text: str, response: str, image_hash: Optional[str] = None):
+    """Save the user message and the assistant reply to the session"""
     from datetime import datetime
     timestamp = datetime.now().isoformat()
     
-    chat_manager.add_message(session_id, {
+    user_message = {
         "role": "user",
         "content": text,
         "timestamp": timestamp
-    }, username)
+    }
+    if image_hash:
+        # Served from /api/images/{hash}; described to the model in later turns
+        user_message["image"] = image_hash
+    chat_manager.add_message(session_id, user_message, username)
     chat_manager.add_message(session_id, {
         "role": "assistant",
         "content": response,
         "timestamp": timestamp
     }, username)
+
+async def _cancel_on_disconnect(request: Request, coro, poll_interval: float = 0.5):
+    """Await coro, cancelling it if the client disconnects before it finishes"""
+    task = asyncio.ensure_future(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_interval)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            raise HTTPException(status_code=499, detail="Client disconnected")
+
+async def _receive_chat_image(image: Optional[UploadFile]):
+    """(stored image, data URI for the model) for an uploaded chat image, or (None, None)"""
+    if not image:
+        return None, None
+    try:
+        stored = await chat_images.put(await image.read())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return stored, await chat_images.data_uri(stored)
+
+@app.get("/api/images/{image_hash}")
+async def get_chat_image(image_hash: str):
+    """An image sent in chat, by content hash (immutable, so cacheable forever)"""
+    stored = chat_images.get(image_hash)
+    if stored is None or not os.path.exists(stored.path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(stored.path, media_type=stored.content_type,
+                        headers={"Cache-Control": "public, max-age=31536000, immutable", **IMAGE_RESPONSE_HEADERS})
+
+@app.post("/api/chat")
+async def chat(
+    request: Request,
+    text: str = Form(...),
+    username: str = Form(...),
+    session_id: Optional[str] = Form(None),
+    image: Optional[UploadFile] = File(None)
+):
+    stored_image, image_uri = await _receive_chat_image(image)
+    session_id, username = await _resolve_chat_session(text, username, session_id)
+    
+    # Prompt context comes from the stored session, not from the client
+    history_list, summary = chat_manager.build_context(session_id, username)
+    history_list = chat_images.annotate_history(history_list)
+    
+    # Generate response (abandoned if the browser goes away)
+    response = await _cancel_on_disconnect(
+        request, llm_service.generate_response(text, image_uri, history_list, summary)
+    )
+    
+    # Save messages to session
+    _save_chat_turn(session_id, username, text, response, stored_image.hash if stored_image else None)
     
     return {
         "response": response,
         "session_id": session_id
     }
 
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(
+    text: str = Form(...),
+    username: str = Form(...),
+    session_id: Optional[str] = Form(None),
+    image: Optional[UploadFile] = File(None)
+):
+    """Stream the reply as Server-Sent Events: session, delta..., done"""
+    started = time.perf_counter()
+    stored_image, image_uri = await _receive_chat_image(image)
+    session_id, username = await _resolve_chat_session(text, username, session_id)
+    
+    history_list, summary = chat_manager.build_context(session_id, username)
+    history_list = chat_images.annotate_history(history_list)
+
+    async def event_stream():
+        yield _sse_event("session", {"session_id": session_id})
+        
+        parts = []
+        ttft_ms = None
+        try:
+            async for delta in llm_service.stream_response(text, image_uri, history_list, summary):
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                parts.append(delta)
+                yield _sse_event("delta", {"text": delta})
+        except LLMStreamError as e:
+            # Nothing is saved for a failed reply, so the turn can simply be sent again
+            print(f"Chat stream {session_id} failed: {e}")
+            yield _sse_event("error", {"message": str(e), "session_id": session_id})
+            return
+        
+        # Only persist once generation has completed
+        response = "".join(parts)
+        _save_chat_turn(session_id, username, text, response, stored_image.hash if stored_image else None)
+        
+        total_ms = round((time.perf_counter() - started) * 1000, 1)
+        print(f"Chat stream {session_id}: ttft={ttft_ms}ms total={total_ms}ms")
+        yield _sse_event("done", {
+            "response": response,
+            "session_id": session_id,
+            "ttft_ms": ttft_ms,
+            "total_ms": total_ms
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Random Miku Image Endpoint
 @app.get("/api/random-miku-image")
-def get_random_miku_image():
-    """Get a random Hatsune Miku image from Safebooru"""
-    image_data = image_service.get_random_miku_image()
+async def get_random_miku_image():
+    """Get a random Hatsune Miku image (served from a prefetched Safebooru pool)"""
+    image_data = await image_service.get_random_miku_image()
     
     if image_data:
         return image_data
@@ -393,10 +597,32 @@ def get_random_miku_image():
 async def get_news(source: str = "all"):
     """Get latest Miku news from specified source"""
     try:
-        # Run in executor to avoid blocking
-        loop = asyncio.get_event_loop()
-        news = await loop.run_in_executor(None, lambda: news_service.get_latest_news(source))
+        # Served from the per-source feed cache; sources are fetched concurrently
+        news = await news_service.get_latest_news(source)
         return {"news": news}
     except Exception as e:
         print(f"News API error: {e}")
         return {"news": []}
+
+
+# Metrics Endpoint
+@app.get("/api/metrics")
+async def get_metrics():
+    """Runtime performance counters"""
+    return {
+        "llm": llm_service.get_metrics(),
+        "response_cache": llm_service.responses.get_stats(),
+        "chat_images": chat_images.get_stats(),
+        "session_cache": chat_manager.cache_stats(),
+        "session_titles": chat_manager.title_stats(),
+        "chat_search": chat_manager.search_stats(),
+        "news_cache": news_service.get_stats(),
+        "http": http_client.get_stats(),
+        "stream_resolver": stream_resolver.get_stats(),
+        "audio_cache": audio_cache.get_stats(),
+        "music_search": music_search.get_stats(),
+        "image_cache": image_cache.get_stats(),
+        "music_library": music_library.get_stats(),
+        "image_pool": image_service.get_stats(),
+        "egress": egress.get_stats()
+    }
@@ -1,6 +1,7 @@
 import json
 import os
 import shutil
+import sys
 
 def migrate_sessions():
     """Migrate old sessions.json to new user-based format"""
@@ -69,11 +70,48 @@ def migrate_sessions():
         print(f"❌ Error during migration: {e}")
         return
 
+def migrate_to_sqlite():
+    """Import every sessions/<user>_sessions.json file into sessions/sessions.db"""
+    from session_store import SqliteSessionStore, read_legacy_json
+    
+    sessions_dir = "sessions"
+    suffix = "_sessions.json"
+    
+    if not os.path.isdir(sessions_dir):
+        print("No sessions directory found. Nothing to migrate.")
+        return
+    
+    files = sorted(f for f in os.listdir(sessions_dir) if f.endswith(suffix))
+    if not files:
+        print(f"No *{suffix} files found. Nothing to migrate.")
+        return
+    
+    store = SqliteSessionStore(os.path.join(sessions_dir, "sessions.db"))
+    total = 0
+    for filename in files:
+        username = filename[:-len(suffix)]
+        try:
+            sessions = read_legacy_json(os.path.join(sessions_dir, filename))
+            imported = store.import_sessions(username, sessions)
+            total += imported
+            print(f"✅ {username}: imported {imported} of {len(sessions)} sessions")
+        except Exception as e:
+            print(f"❌ Error migrating {filename}: {e}")
+    
+    print(f"\n🎉 Migration complete! {total} sessions imported into {store.db_path}")
+    print("The JSON files were left in place as a backup.")
+
 if __name__ == "__main__":
     print("=" * 50)
     print("MikuChat Session Migration Tool")
     print("=" * 50)
-    print("\nThis tool will migrate your old sessions.json")
-    print("to the new user-based format.\n")
     
-    migrate_sessions()
+    if "--sqlite" in sys.argv:
+        print("\nThis tool will import your per-user session files")
+        print("into the SQLite session store.\n")
+        migrate_to_sqlite()
+    else:
+        print("\nThis tool will migrate your old sessions.json")
+        print("to the new user-based format.\n")
+        print("(Run with --sqlite to import per-user files into the SQLite store.)\n")
+        migrate_sessions()
@@ -0,0 +1,127 @@
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional
+from dashscope import Generation, MultiModalConversation
+
+# Models per task, first choice first; later ones are fallbacks on timeouts and quota/overload errors
+LLM_VISION_MODELS = os.getenv("LLM_VISION_MODELS", "qwen-vl-max,qwen-vl-plus")
+# Text-only chat turns (no image attached)
+LLM_CHAT_MODELS = os.getenv("LLM_CHAT_MODELS", "qwen-plus,qwen-vl-max")
+# Session titles, summaries and other short utility prompts
+LLM_UTILITY_MODELS = os.getenv("LLM_UTILITY_MODELS", "qwen-turbo,qwen-plus")
+TASKS = ("vision", "chat", "utility")
+# Latency samples kept per model for percentiles
+LATENCY_SAMPLES = 200
+
+def is_vision_model(model: str) -> bool:
+    """Qwen VL (and omni) models take multimodal content; the rest are text-only Generation models"""
+    return "-vl" in model or "omni" in model
+
+def sdk_call(model: str):
+    return MultiModalConversation.call if is_vision_model(model) else Generation.call
+
+def adapt_messages(model: str, messages: List[Dict]) -> List[Dict]:
+    """Convert multimodal [{"text": ...}] content to plain strings for text models"""
+    if is_vision_model(model):
+        return messages
+    return [
+        {"role": m["role"], "content": "".join(part.get("text", "") for part in m["content"])}
+        if isinstance(m["content"], list) else m
+        for m in messages
+    ]
+
+def sdk_kwargs(model: str) -> Dict:
+    # Text models answer in the same choices/message shape as the VL ones with result_format="message"
+    return {} if is_vision_model(model) else {"result_format": "message"}
+
+def response_text(response) -> str:
+    """Text of a reply (or streamed delta) from either SDK entry point"""
+    content = response.output.choices[0].message.content
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content) if content else ""
+
+def should_fall_back(response) -> bool:
+    """Errors another model may not have: rate/quota limits and server-side failures"""
+    code = str(getattr(response, "code", "") or "")
+    return response.status_code == 429 or response.status_code >= 500 or code.startswith("Throttling")
+
+class _ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        # Time attempts spent waiting for a free LLM worker thread, kept out of the latencies
+        self.queue_waits = deque(maxlen=LATENCY_SAMPLES)
+
+    def as_dict(self) -> dict:
+        samples = sorted(self.latencies)
+        stats = {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+            "error_rate": round(self.errors / self.calls, 3) if self.calls else None,
+        }
+        if samples:
+            stats["latency_avg_ms"] = round(sum(samples) / len(samples), 1)
+            stats["latency_p95_ms"] = round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1)
+        if self.queue_waits:
+            stats["queue_wait_avg_ms"] = round(sum(self.queue_waits) / len(self.queue_waits), 1)
+            stats["queue_wait_max_ms"] = round(max(self.queue_waits), 1)
+        return stats
+
+class ModelRouter:
+    """Picks the DashScope model for each kind of call and tracks how each model performs.
+
+    Image turns go to a VL model; text-only chat and utility prompts
+    (titles, summaries) go to cheaper text models. Each task has an
+    ordered list of models: LLMService tries the next one when a call
+    times out or is throttled. Latency is measured per attempt (for
+    streams, up to the first chunk) and excludes time spent waiting for
+    a free worker thread, which is reported separately as queue wait.
+    """
+
+    def __init__(self, routes: Optional[Dict[str, List[str]]] = None):
+        if routes is None:
+            routes = {
+                "vision": LLM_VISION_MODELS,
+                "chat": LLM_CHAT_MODELS,
+                "utility": LLM_UTILITY_MODELS,
+            }
+            routes = {task: [m.strip() for m in models.split(",") if m.strip()] for task, models in routes.items()}
+        self.routes = routes
+        self._stats: Dict[str, _ModelStats] = {}
+
+    def models_for(self, task: str) -> List[str]:
+        return self.routes.get(task) or self.routes["vision"]
+
+    def _model_stats(self, model: str) -> _ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = _ModelStats()
+        return stats
+
+    def record(self, model: str, started: float, ok: bool, timed_out: bool = False, fell_back: bool = False,
+               queued: float = 0.0):
+        """Outcome of one attempt; `queued` is the part of it (in seconds) spent waiting for a worker thread"""
+        stats = self._model_stats(model)
+        stats.calls += 1
+        stats.queue_waits.append(queued * 1000)
+        if ok:
+            stats.latencies.append((time.perf_counter() - started - queued) * 1000)
+        else:
+            stats.errors += 1
+        if timed_out:
+            stats.timeouts += 1
+        if fell_back:
+            stats.fallbacks += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "routes": self.routes,
+            "models": {model: stats.as_dict() for model, stats in self._stats.items()},
+        }
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+from cache_utils import SingleFlight
+
+try:
+    import mutagen
+except ImportError:  # Duration and tags are optional; files are still listed without mutagen
+    mutagen = None
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".mp4", ".m4a", ".flac")
+# In lookup order: the first existing <basename><ext> is the track's cover
+COVER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+LIBRARY_INDEX_PATH = os.path.join("cache", "music_library.json")
+SORT_FIELDS = ("name", "title", "artist", "album", "duration", "size", "added")
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_metadata(path: str) -> Dict:
+    """Duration (seconds) and title/artist/album tags of an audio file, empty without mutagen"""
+    if mutagen is None:
+        return {}
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as e:
+        print(f"Error reading tags of {path}: {e}")
+        return {}
+    if audio is None:
+        return {}
+    meta = {}
+    if audio.info is not None and getattr(audio.info, "length", None):
+        meta["duration"] = round(audio.info.length, 1)
+    tags = audio.tags or {}
+    for field in ("title", "artist", "album"):
+        try:
+            values = tags.get(field)
+        except Exception:
+            values = None
+        if values:
+            meta[field] = str(values[0])
+    return meta
+
+class MusicLibrary:
+    """Persistent index of the local music directory.
+
+    The directory is scanned once at startup and again whenever its mtime
+    changes (files added, removed or renamed) or an upload asks for it.
+    A scan only reads tags of files whose size or mtime changed since the
+    index was saved, so listing never touches the disk per file.
+    """
+
+    def __init__(self, music_dir: str = "music", index_path: str = LIBRARY_INDEX_PATH):
+        self.music_dir = music_dir
+        self.index_path = index_path
+        # file name -> {name, size, mtime, cover, duration?, title?, artist?, album?, sha256?}
+        self._tracks: Dict[str, Dict] = {}
+        self._dir_mtime: Optional[int] = None
+        self._flight = SingleFlight()
+        self.scans = 0
+        self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._tracks = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Error loading music library index: {e}")
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._tracks, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _scan(self, dir_mtime: int):
+        """Rebuild the index from one directory listing (blocking)"""
+        stats = {}
+        with os.scandir(self.music_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stats[entry.name] = entry.stat()
+
+        tracks = {}
+        changed = False
+        for name, st in stats.items():
+            base_name, ext = os.path.splitext(name)
+            if ext.lower() not in AUDIO_EXTENSIONS:
+                continue
+            cover = next((base_name + e for e in COVER_EXTENSIONS if base_name + e in stats), None)
+            track = self._tracks.get(name)
+            if track is None or track["size"] != st.st_size or track["mtime"] != st.st_mtime:
+                track = {"name": name, "size": st.st_size, "mtime": st.st_mtime,
+                         **read_metadata(os.path.join(self.music_dir, name))}
+                changed = True
+            elif track.get("cover") != cover:
+                changed = True
+            tracks[name] = {**track, "cover": cover}
+
+        changed = changed or len(tracks) != len(self._tracks)
+        self._tracks = tracks
+        self._dir_mtime = dir_mtime
+        self.scans += 1
+        if changed:
+            self._save_index()
+
+    async def refresh(self, force: bool = False):
+        """Rescan if the directory changed since the last scan (or always with force)"""
+        if not os.path.isdir(self.music_dir):
+            self._tracks = {}
+            return
+        dir_mtime = os.stat(self.music_dir).st_mtime_ns
+        if not force and dir_mtime == self._dir_mtime:
+            return
+        loop = asyncio.get_event_loop()
+        await self._flight.do("scan", lambda: loop.run_in_executor(None, self._scan, dir_mtime))
+
+    async def find_duplicate(self, size: int, sha256: str) -> Optional[str]:
+        """Name of an indexed track with exactly this content.
+
+        Only tracks of the same size are hashed, and each hash is remembered
+        in the index until the file changes.
+        """
+        loop = asyncio.get_event_loop()
+        for track in list(self._tracks.values()):
+            if track["size"] != size:
+                continue
+            if "sha256" not in track:
+                path = os.path.join(self.music_dir, track["name"])
+                try:
+                    track["sha256"] = await loop.run_in_executor(None, file_sha256, path)
+                except OSError:
+                    continue
+                self._save_index()
+            if track["sha256"] == sha256:
+                return track["name"]
+        return None
+
+    def remember_hash(self, name: str, sha256: str):
+        track = self._tracks.get(name)
+        if track is not None:
+            track["sha256"] = sha256
+            self._save_index()
+
+    def query(self, q: Optional[str] = None, sort: str = "name", descending: bool = False,
+              offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Dict], int]:
+        """(page of tracks, total matches), filtered by a case-insensitive substring of name or tags"""
+        tracks = list(self._tracks.values())
+        if q:
+            needle = q.casefold()
+            tracks = [
+                t for t in tracks
+                if any(needle in str(t.get(field) or "").casefold() for field in ("name", "title", "artist", "album"))
+            ]
+
+        field = "mtime" if sort == "added" else sort
+
+        def sort_key(track):
+            value = track.get(field)
+            if isinstance(value, str):
+                value = value.casefold()
+            # Tracks without the field sort last either way
+            return (value is None) != descending, value if value is not None else 0
+
+        tracks.sort(key=sort_key, reverse=descending)
+        total = len(tracks)
+        end = None if limit is None else offset + limit
+        return tracks[offset:end], total
+
+    def get_stats(self) -> dict:
+        return {"tracks": len(self._tracks), "scans": self.scans, "tags_enabled": mutagen is not None}
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import unicodedata
+from typing import Dict, Optional, Union
+from urllib.parse import quote
+from cache_utils import SingleFlight, TTLCache
+from http_client import HttpClient, BROWSER_USER_AGENT
+from egress import EgressManager
+from image_cache import COVER_THUMB_WIDTH
+
+# How long a search result page is reused across users
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+# Cached (query, page) results kept in memory (LRU)
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "500"))
+SEARCH_PAGE_SIZE = 10
+
+def normalize_query(q: str) -> str:
+    """Fold width/case and collapse whitespace so equivalent queries share a cache entry"""
+    return " ".join(unicodedata.normalize("NFKC", q).casefold().split())
+
+class MusicSearch:
+    """Bilibili video search with a per-page result cache.
+
+    Pages are cached independently under (normalized keyword, page), so
+    fetching page 2 never re-runs page 1, and identical searches that are
+    in flight at the same time share one upstream request.
+    """
+
+    def __init__(self, http: Union[HttpClient, EgressManager], ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_SIZE):
+        self.http = http
+        self.url = "https://api.bilibili.com/x/web-interface/search/type"
+        self.headers = {
+            "User-Agent": BROWSER_USER_AGENT,
+            "Referer": "https://www.bilibili.com/",
+            "Cookie": "buvid3=infoc;"
+        }
+        self._cache = TTLCache(max_entries, ttl)
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def search_keyword(q: str) -> str:
+        keyword = normalize_query(q)
+        # Append "初音未来" to search query if not present
+        if "初音" not in keyword and "miku" not in keyword:
+            keyword = f"{keyword} 初音未来"
+        return keyword
+
+    async def _fetch_page(self, keyword: str, page: int) -> Optional[Dict]:
+        """One page from the Bilibili Search API; None on failure (not cached)"""
+        params = {
+            "search_type": "video",
+            "keyword": keyword,
+            "page": page,
+            "page_size": SEARCH_PAGE_SIZE
+        }
+        response = await self.http.get(self.url, params=params, headers=self.headers)
+
+        if response.status_code != 200:
+            print(f"Bilibili API Error: Status {response.status_code}")
+            print(f"Response: {response.text[:200]}")
+            return None
+
+        try:
+            data = response.json()
+        except Exception as e:
+            print(f"JSON Decode Error: {e}")
+            print(f"Raw Response: {response.text[:200]}")
+            return None
+
+        if data.get('code') != 0:
+            print(f"Bilibili API Error: code {data.get('code')} {data.get('message')}")
+            return None
+
+        results = []
+        if 'data' in data and 'result' in data['data']:
+            video_list = data['data']['result'] or []
+            for video in video_list:
+                # Filter out non-video items just in case
+                if video.get('type') != 'video':
+                    continue
+
+                # Construct cover URL
+                cover_url = video.get('pic', '')
+                if cover_url.startswith('//'):
+                    cover_url = 'https:' + cover_url
+
+                # Use proxy for cover
+                proxied_cover = f"http://localhost:8000/api/proxy/image?url={quote(cover_url, safe='')}&w={COVER_THUMB_WIDTH}" if cover_url else None
+
+                results.append({
+                    "id": video['bvid'],
+                    "title": video['title'].replace('<em class="keyword">', '').replace('</em>', ''), # Clean highlight tags
+                    "duration": video.get('duration', '0'), # Format is usually "MM:SS" or seconds? API returns "MM:SS" string often
+                    "uploader": video.get('author', 'Unknown'),
+                    "type": "online",
+                    "cover": proxied_cover
+                })
+
+        num_pages = data.get('data', {}).get('numPages') or page
+        payload = {"results": results, "page": page, "has_more": page < num_pages}
+        body = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return {"payload": payload, "etag": '"' + hashlib.sha1(body).hexdigest()[:16] + '"'}
+
+    async def search(self, q: str, page: int = 1) -> Optional[Dict]:
+        """{"payload", "etag", "max_age"} for a query page; None if the upstream failed"""
+        key = (self.search_keyword(q), page)
+        entry = self._cache.get(key)
+        if entry is None:
+            async def fetch():
+                result = await self._fetch_page(*key)
+                if result is not None:
+                    self._cache.set(key, result)
+                return result
+            entry = await self._flight.do(key, fetch)
+            if entry is None:
+                return None
+        return {**entry, "max_age": int(self._cache.remaining(key))}
+
+    def get_stats(self) -> dict:
+        return {**self._cache.stats(), "coalesced": self._flight.coalesced}
@@ -1,10 +1,36 @@
-import requests
-from datetime import datetime
+from typing import Callable, Dict, List, Optional, Union
 import json
+import os
+import time
 import asyncio
+from cache_utils import SingleFlight
+from feed_parser import FeedParser, html_to_text
+from http_client import HttpClient
+from egress import EgressManager
+
+# Serve cached feeds for this many seconds before revalidating
+NEWS_CACHE_TTL = float(os.getenv("NEWS_CACHE_TTL", "300"))
+# Past the TTL, keep serving the old items (while refreshing in the background) up to this age
+NEWS_STALE_TTL = float(os.getenv("NEWS_STALE_TTL", "3600"))
+# Seconds /api/news waits for all sources; slower ones are returned on a later request
+NEWS_DEADLINE = float(os.getenv("NEWS_DEADLINE", "4"))
+# Items kept per source; the download stops once this many have been parsed
+NEWS_MAX_ITEMS = int(os.getenv("NEWS_MAX_ITEMS", "30"))
+# Leading characters of a post used for the snippet and keyword classification
+SNIPPET_SCAN_CHARS = 1000
+
+class _FeedEntry:
+    """Cached items of one news source plus the validators for conditional GETs"""
 
-class NewsService:
     def __init__(self):
+        self.items: List[Dict] = []
+        self.fetched_at = 0.0
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+
+class NewsService:
+    def __init__(self, ttl: float = NEWS_CACHE_TTL, stale_ttl: float = NEWS_STALE_TTL,
+                 deadline: float = NEWS_DEADLINE, http: Optional[Union[HttpClient, EgressManager]] = None):
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
             "Referer": "https://www.bilibili.com/"
@@ -20,6 +46,29 @@ class NewsService:
             "社区动态": ["粉丝", "同人", "创作", "感谢"]
         }
 
+        # source name -> (feed url, mapper from parsed feed entries to news items)
+        self.sources: Dict[str, tuple] = {}
+        self.register_source("piapro", "https://blog.piapro.net/feed", self._piapro_news_items)
+        self.register_source(
+            "google",
+            "https://news.google.com/rss/search?q=%E5%88%9D%E9%9F%B3%E6%9C%AA%E6%9D%A5&hl=zh-CN&gl=CN&ceid=CN:zh-Hans",
+            self._google_news_items
+        )
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.deadline = deadline
+        self._entries: Dict[str, _FeedEntry] = {}
+        self._flight = SingleFlight()
+        self._background: set = set()
+        self._http = http or HttpClient()
+        self.stats = {
+            "hits": 0, "stale_hits": 0, "misses": 0, "not_modified": 0, "fetch_errors": 0, "deadline_misses": 0
+        }
+
+    def register_source(self, name: str, url: str, mapper: Callable[[List[Dict]], List[Dict]]):
+        """Add an RSS/Atom feed; `mapper` turns FeedParser entries into news items"""
+        self.sources[name] = (url, mapper)
+
     def _classify_news(self, text):
         """Classify news based on keywords"""
         text_lower = text.lower()
@@ -28,156 +77,158 @@ class NewsService:
                 return category
         return "社区动态"  # Default category
 
-    def get_google_news(self):
+    def _google_news_items(self, entries: List[Dict]) -> List[Dict]:
+        """Map Google News RSS entries to news items"""
+        news_items = []
+        for entry in entries:
+            # Google News doesn't usually have images in RSS, but the description has a snippet
+            desc_clean, _ = html_to_text(entry["summary"], max_chars=SNIPPET_SCAN_CHARS)
+            news_items.append({
+                "id": entry["link"],
+                "title": entry["title"] or "No Title",
+                "content": desc_clean[:200] + "...",
+                "category": self._classify_news(entry["title"]),
+                "source": "Google News",
+                "publishTime": entry["published"],
+                "url": entry["link"],
+                "thumbnail": None # Google RSS doesn't provide good thumbnails
+            })
+        return news_items
+
+    async def get_google_news(self):
         """Fetch news from Google News RSS"""
-        url = "https://news.google.com/rss/search?q=%E5%88%9D%E9%9F%B3%E6%9C%AA%E6%9D%A5&hl=zh-CN&gl=CN&ceid=CN:zh-Hans"
+        return await self._get_source("google")
+
+    async def _fetch_feed(self, url: str, entry: _FeedEntry, mapper: Callable[[List[Dict]], List[Dict]]) -> Optional[List[Dict]]:
+        """Conditional GET of a feed. Returns parsed items, or None if unchanged (304)"""
+        headers = dict(self.headers)
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
         
-        try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+        async with self._http.stream("GET", url, headers=headers, timeout=10) as response:
+            if response.status_code == 304:
+                return None
             if response.status_code != 200:
-                return []
-                
-            content = response.text
-            import re
-            import html
+                raise RuntimeError(f"HTTP {response.status_code}")
             
-            items = re.findall(r'<item>(.*?)</item>', content, re.DOTALL)
-            news_items = []
+            # Parse while downloading and hang up once we have enough items
+            parser = FeedParser(max_items=NEWS_MAX_ITEMS)
+            async for chunk in response.aiter_bytes(16384):
+                if parser.feed(chunk):
+                    break
+            items = parser.close()
             
-            for item in items:
-                try:
-                    title_match = re.search(r'<title>(.*?)</title>', item)
-                    title = title_match.group(1) if title_match else "No Title"
-                    
-                    link_match = re.search(r'<link>(.*?)</link>', item)
-                    link = link_match.group(1) if link_match else ""
-                    
-                    date_match = re.search(r'<pubDate>(.*?)</pubDate>', item)
-                    pub_date = date_match.group(1) if date_match else ""
-                    
-                    # Format date: Tue, 05 Aug 2025 07:00:00 GMT -> 2025-08-05 07:00
-                    try:
-                        dt = datetime.strptime(pub_date, "%a, %d %b %Y %H:%M:%S %Z")
-                        pub_date = dt.strftime("%Y-%m-%d %H:%M")
-                    except:
-                        pass
-                        
-                    # Google News doesn't usually have images in RSS, but we can try to find description
-                    desc_match = re.search(r'<description>(.*?)</description>', item, re.DOTALL)
-                    desc = desc_match.group(1) if desc_match else ""
-                    
-                    # Unescape HTML entities (fixes &lt;a href=... issues)
-                    desc = html.unescape(desc)
-                    # Remove HTML tags
-                    desc_clean = re.sub(r'<[^>]+>', '', desc).strip()
-                    
-                    news_items.append({
-                        "id": link,
-                        "title": title,
-                        "content": desc_clean[:200] + "...",
-                        "category": self._classify_news(title),
-                        "source": "Google News",
-                        "publishTime": pub_date,
-                        "url": link,
-                        "thumbnail": None # Google RSS doesn't provide good thumbnails
-                    })
-                except:
-                    continue
-                    
-            return news_items
-        except Exception as e:
-            print(f"Google News fetch error: {e}")
-            return []
+            entry.etag = response.headers.get("ETag")
+            entry.last_modified = response.headers.get("Last-Modified")
+        return mapper(items)
 
-    def get_latest_news(self, source='all'):
-        """Fetch latest news from specified source"""
-        news = []
+    async def _refresh_source(self, name: str) -> List[Dict]:
+        """Fetch one source upstream, concurrent callers share a single request"""
+        async def refresh():
+            url, mapper = self.sources[name]
+            entry = self._entries.setdefault(name, _FeedEntry())
+            try:
+                items = await self._fetch_feed(url, entry, mapper)
+            except Exception as e:
+                print(f"News fetch error ({name}): {e}")
+                self.stats["fetch_errors"] += 1
+                # Keep serving what we had; retry after another TTL
+                if entry.fetched_at:
+                    entry.fetched_at = time.monotonic()
+                return entry.items
+            if items is None:
+                self.stats["not_modified"] += 1
+            else:
+                entry.items = items
+            entry.fetched_at = time.monotonic()
+            return entry.items
         
-        if source in ['all', 'piapro']:
-            news.extend(self._get_piapro_news())
-            
-        if source in ['all', 'google']:
-            news.extend(self.get_google_news())
+        return await self._flight.do(name, refresh)
+
+    def _refresh_in_background(self, name: str):
+        if self._flight.in_flight(name):
+            return
+        task = asyncio.ensure_future(self._refresh_source(name))
+        # Keep a reference until the refresh finishes
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _get_source(self, name: str) -> List[Dict]:
+        """Cached items of one source: fresh within the TTL, stale-while-revalidate after it"""
+        entry = self._entries.get(name)
+        if entry is not None and entry.fetched_at:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self.stats["hits"] += 1
+                return entry.items
+            if age < self.stale_ttl:
+                self.stats["stale_hits"] += 1
+                self._refresh_in_background(name)
+                return entry.items
+        self.stats["misses"] += 1
+        return await self._refresh_source(name)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "coalesced": self._flight.coalesced}
+
+    async def get_latest_news(self, source='all'):
+        """Fetch latest news from specified source ('all' for every registered one).
+        
+        Sources are fetched concurrently; whatever hasn't arrived within the deadline is
+        left out of this response and keeps loading into the cache in the background.
+        """
+        names = list(self.sources) if source == 'all' else [source] if source in self.sources else []
+        if not names:
+            return []
+        
+        tasks = {asyncio.ensure_future(self._get_source(name)): name for name in names}
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending:
+            print(f"News source {tasks[task]} missed the {self.deadline:g}s deadline")
+            self.stats["deadline_misses"] += 1
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        
+        news = []
+        for task in done:
+            news.extend(task.result())
             
         # Sort by date (newest first)
         news.sort(key=lambda x: x['publishTime'], reverse=True)
         return news
 
-    def _get_piapro_news(self):
-        """Fetch latest news from Piapro Blog RSS"""
-        url = "https://blog.piapro.net/feed"
-        
-        try:
-            response = requests.get(url, headers=self.headers, timeout=10)
-            if response.status_code != 200:
-                print(f"RSS Fetch Error: {response.status_code}")
-                return []
-                
-            content = response.text
-            import re
-            
-            # Simple regex for RSS parsing
-            items = re.findall(r'<item>(.*?)</item>', content, re.DOTALL)
-            news_items = []
+    def _piapro_news_items(self, entries: List[Dict]) -> List[Dict]:
+        """Map Piapro Blog RSS entries to news items"""
+        news_items = []
+        for entry in entries:
+            # Full post body for thumbnail and snippet, falling back to the excerpt
+            desc_clean, images = html_to_text(entry["content"] or entry["summary"], max_chars=SNIPPET_SCAN_CHARS)
             
-            for item in items:
-                try:
-                    # Extract title
-                    title_match = re.search(r'<title>(.*?)</title>', item)
-                    title = title_match.group(1) if title_match else "No Title"
-                    title = title.replace('<![CDATA[', '').replace(']]>', '')
-                    
-                    # Extract link
-                    link_match = re.search(r'<link>(.*?)</link>', item)
-                    link = link_match.group(1) if link_match else ""
-                    
-                    # Extract date
-                    date_match = re.search(r'<pubDate>(.*?)</pubDate>', item)
-                    pub_date = date_match.group(1) if date_match else ""
-                    # Format date: Thu, 27 Nov 2025 08:00:02 +0000 -> 2025-11-27 08:00
-                    try:
-                        dt = datetime.strptime(pub_date, "%a, %d %b %Y %H:%M:%S %z")
-                        pub_date = dt.strftime("%Y-%m-%d %H:%M")
-                    except:
-                        pass
-                    
-                    # Extract content/description for thumbnail and snippet
-                    desc_match = re.search(r'<content:encoded>(.*?)</content:encoded>', item, re.DOTALL)
-                    if not desc_match:
-                        desc_match = re.search(r'<description>(.*?)</description>', item, re.DOTALL)
-                    
-                    desc = desc_match.group(1) if desc_match else ""
-                    desc_clean = re.sub(r'<[^>]+>', '', desc).replace('<![CDATA[', '').replace(']]>', '').strip()
-                    
-                    # Find image in description
-                    img_match = re.search(r'<img.*?src="([^"]+)".*?>', desc)
-                    thumbnail = img_match.group(1) if img_match else None
-                    
-                    # Filter out emoji images (wp-includes/images/smilies or s.w.org)
-                    if thumbnail and ('s.w.org' in thumbnail or 'emoji' in thumbnail):
-                        thumbnail = None
-                        
-                    news_items.append({
-                        "id": link, # Use link as ID
-                        "title": title,
-                        "content": desc_clean[:200] + "...",
-                        "category": self._classify_news(title + " " + desc_clean),
-                        "source": "Piapro官方博客",
-                        "publishTime": pub_date,
-                        "url": link,
-                        "thumbnail": thumbnail
-                    })
-                except Exception as e:
-                    print(f"Error parsing RSS item: {e}")
-                    continue
-                    
-            return news_items
+            # Filter out emoji images (wp-includes/images/smilies or s.w.org)
+            thumbnail = images[0] if images else None
+            if thumbnail and ('s.w.org' in thumbnail or 'emoji' in thumbnail):
+                thumbnail = None
             
-        except Exception as e:
-            print(f"News fetch error: {e}")
-            return []
+            title = entry["title"] or "No Title"
+            news_items.append({
+                "id": entry["link"], # Use link as ID
+                "title": title,
+                "content": desc_clean[:200] + "...",
+                "category": self._classify_news(title + " " + desc_clean),
+                "source": "Piapro官方博客",
+                "publishTime": entry["published"],
+                "url": entry["link"],
+                "thumbnail": thumbnail
+            })
+        return news_items
+
+    async def _get_piapro_news(self):
+        """Fetch latest news from Piapro Blog RSS"""
+        return await self._get_source("piapro")
 
 if __name__ == "__main__":
     service = NewsService()
-    news = service.get_latest_news()
+    news = asyncio.run(service.get_latest_news())
     print(json.dumps(news, indent=2, ensure_ascii=False))
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import random
+import unicodedata
+from typing import Dict, List, Optional
+from cache_utils import TTLCache
+
+# Reuse replies to repeated prompts (greetings, stock questions); off by default
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+# Distinct replies collected per prompt before cached ones are served (picked at random)
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "1"))
+# Trailing history messages that must match for a cached reply to apply
+RESPONSE_CACHE_CONTEXT = 2
+# Longer prompts are practically never repeated, so they are not cached
+CACHEABLE_PROMPT_CHARS = 200
+# Trailing punctuation ignored when matching ("你好！" == "你好")
+_TRAILING_PUNCTUATION = "!?.~,。！？～，、…"
+
+def normalize_prompt(text: str) -> str:
+    """Fold width/case, collapse whitespace and drop trailing punctuation"""
+    text = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+    return text.rstrip(_TRAILING_PUNCTUATION + " ")
+
+def context_hash(history: List[Dict], summary: Optional[str] = None) -> str:
+    """Hash of the conversation state a reply depends on: the last few turns and the summary"""
+    recent = [(m.get("role"), m.get("content")) for m in history[-RESPONSE_CACHE_CONTEXT:]] if RESPONSE_CACHE_CONTEXT else []
+    payload = json.dumps([recent, summary or ""], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+class ResponseCache:
+    """Cache of model replies keyed on (model, normalized prompt, recent-context hash).
+
+    With `variants` > 1 the first K replies to a prompt are collected from the
+    model and afterwards one of them is served at random, so cached greetings
+    don't all read the same. Entries expire after `ttl` seconds, counted from
+    the first reply, and the least recently used are evicted beyond
+    `max_entries`. Turns with images are never cached.
+    """
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE, ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_SIZE, variants: int = RESPONSE_CACHE_VARIANTS):
+        self.enabled = enabled
+        self.variants = max(1, variants)
+        self._cache = TTLCache(max_entries, ttl)
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "uncacheable": 0}
+
+    def key(self, model: str, text: str, history: List[Dict], summary: Optional[str] = None,
+            has_image: bool = False) -> Optional[tuple]:
+        """Cache key for a turn, or None if the turn must go to the model"""
+        if not self.enabled:
+            return None
+        prompt = normalize_prompt(text)
+        if has_image or not prompt or len(prompt) > CACHEABLE_PROMPT_CHARS:
+            self.stats["uncacheable"] += 1
+            return None
+        return model, prompt, context_hash(history, summary)
+
+    def get(self, key: Optional[tuple]) -> Optional[str]:
+        if key is None:
+            return None
+        replies = self._cache.get(key)
+        if not replies or len(replies) < self.variants:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return random.choice(replies)
+
+    def put(self, key: Optional[tuple], reply: str):
+        """Remember a successful reply (as one more variant, up to the configured count)"""
+        if key is None or not reply.strip():
+            return
+        replies = self._cache.get(key)
+        if replies is None:
+            self._cache.set(key, [reply])
+        elif len(replies) < self.variants and reply not in replies:
+            # Keep the entry's original expiry
+            self._cache.set(key, replies + [reply], ttl=self._cache.remaining(key))
+        else:
+            return
+        self.stats["stores"] += 1
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "entries": len(self._cache),
+            "evictions": self._cache.evictions,
+            "variants": self.variants,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else None,
+        }
@@ -0,0 +1,218 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Tuple
+from session_store import safe_username
+
+# Han, kana, CJK compatibility and Hangul: scripts written without spaces
+CJK_CHARS = "\u3005\u3007\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+# A CJK run, or a word of other letters/digits
+_TERM_RE = re.compile(f"([{CJK_CHARS}]+)|([^\\W_{CJK_CHARS}]+)")
+# Characters of context shown around the first match
+SNIPPET_CHARS = 120
+# Messages written per transaction when indexing existing history
+BACKFILL_BATCH = 2000
+
+def normalize_text(text: str) -> str:
+    """NFKC (full-width ASCII, half-width kana) and case folding, shared by documents and queries"""
+    return unicodedata.normalize("NFKC", text).casefold()
+
+def query_terms(text: str) -> List[str]:
+    """Words and CJK runs of a text, normalized"""
+    return [match.group(0) for match in _TERM_RE.finditer(normalize_text(text))]
+
+def index_tokens(text: str) -> List[str]:
+    """Tokens stored for a document.
+
+    Words are kept whole. CJK runs become overlapping bigrams followed by
+    their last character, so a phrase of a query's bigrams matches the run
+    anywhere and a one-character query matches as a prefix.
+    """
+    tokens = []
+    for match in _TERM_RE.finditer(normalize_text(text)):
+        term = match.group(0)
+        if match.group(1):
+            tokens.extend(term[i:i + 2] for i in range(len(term) - 1))
+            tokens.append(term[-1])
+        else:
+            tokens.append(term)
+    return tokens
+
+def match_expression(terms: List[str]) -> str:
+    """FTS5 query requiring every term; words match as prefixes"""
+    parts = []
+    for term in terms:
+        if _TERM_RE.fullmatch(term).group(1) and len(term) > 1:
+            parts.append('"' + " ".join(term[i:i + 2] for i in range(len(term) - 1)) + '"')
+        else:
+            parts.append(f'"{term}"*')
+    return " ".join(parts)
+
+def highlight(content: str, terms: List[str], width: int = SNIPPET_CHARS) -> Tuple[str, List[List[int]]]:
+    """A snippet around the first match and the [start, end) ranges of matches within it"""
+    # Match on the normalized text (so "ＭＩＫＵ" is found by "miku"), mapping positions back
+    normalized, positions = [], []
+    for index, char in enumerate(content):
+        folded = normalize_text(char)
+        normalized.append(folded)
+        positions.extend([index] * len(folded))
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)))
+    matches = [
+        (positions[m.start()], positions[m.end() - 1] + 1)
+        for m in pattern.finditer("".join(normalized))
+    ] if terms else []
+    if not matches:
+        return content[:width] + ("…" if len(content) > width else ""), []
+    start = max(0, matches[0][0] - width // 3)
+    end = min(len(content), start + width)
+    prefix = "…" if start > 0 else ""
+    snippet = prefix + content[start:end] + ("…" if end < len(content) else "")
+    ranges = [
+        [m_start - start + len(prefix), min(m_end, end) - start + len(prefix)]
+        for m_start, m_end in matches if start <= m_start < end
+    ]
+    return snippet, ranges
+
+class SearchIndex:
+    """Per-user full-text index over chat messages (SQLite FTS5).
+
+    Messages are indexed as they are added; a user's older history is
+    indexed from the session store the first time they search. The text
+    is tokenized here rather than by SQLite, so Chinese and Japanese are
+    searchable without a CJK tokenizer extension. It lives in its own
+    database, next to either session store backend.
+    """
+
+    def __init__(self, db_path: str = os.path.join("sessions", "search.db")):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS search_docs (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT,
+                timestamp TEXT,
+                content TEXT NOT NULL,
+                UNIQUE (username, session_id, seq)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(tokens);
+            CREATE TABLE IF NOT EXISTS search_users (
+                username TEXT PRIMARY KEY
+            );
+        """)
+        self._conn.commit()
+        self.stats = {"searches": 0, "backfills": 0, "search_ms_total": 0.0}
+
+    def _insert(self, user: str, session_id: str, seq: int, message: Dict):
+        content = message.get("content")
+        if not isinstance(content, str) or not content.strip():
+            return
+        cursor = self._conn.execute(
+            """INSERT OR IGNORE INTO search_docs (username, session_id, seq, role, timestamp, content)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (user, session_id, seq, message.get("role"), message.get("timestamp"), content)
+        )
+        if cursor.rowcount:
+            self._conn.execute(
+                "INSERT INTO search_fts (rowid, tokens) VALUES (?, ?)",
+                (cursor.lastrowid, " ".join(index_tokens(content)))
+            )
+
+    def add(self, username: str, session_id: str, seq: int, message: Dict):
+        """Index one new message (idempotent per session position)"""
+        with self._lock, self._conn:
+            self._insert(safe_username(username), session_id, seq, message)
+
+    def delete_session(self, username: str, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                """DELETE FROM search_fts WHERE rowid IN
+                   (SELECT id FROM search_docs WHERE username = ? AND session_id = ?)""",
+                (safe_username(username), session_id)
+            )
+            self._conn.execute("DELETE FROM search_docs WHERE username = ? AND session_id = ?",
+                               (safe_username(username), session_id))
+
+    def is_indexed(self, username: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM search_users WHERE username = ?", (safe_username(username),)
+            ).fetchone() is not None
+
+    def backfill(self, username: str, messages: Iterable[Tuple[str, int, Dict]]):
+        """Index a user's existing (session_id, seq, message) history once.
+
+        Runs in batches so messages added meanwhile are not held up behind it;
+        both paths skip positions that are already indexed.
+        """
+        user = safe_username(username)
+        batch = []
+        for item in messages:
+            batch.append(item)
+            if len(batch) >= BACKFILL_BATCH:
+                self._insert_batch(user, batch)
+                batch = []
+        self._insert_batch(user, batch)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO search_users (username) VALUES (?)", (user,))
+        self.stats["backfills"] += 1
+
+    def _insert_batch(self, user: str, batch: List[Tuple[str, int, Dict]]):
+        with self._lock, self._conn:
+            for session_id, seq, message in batch:
+                self._insert(user, session_id, seq, message)
+
+    def search(self, username: str, query: str, offset: int = 0, limit: int = 20) -> Tuple[List[Dict], int]:
+        """(page of hits, total hits), best match first, each with a highlighted snippet"""
+        terms = query_terms(query)
+        if not terms:
+            return [], 0
+        started = time.perf_counter()
+        expression = match_expression(terms)
+        user = safe_username(username)
+        where = "FROM search_fts CROSS JOIN search_docs d ON d.id = search_fts.rowid WHERE search_fts MATCH ? AND d.username = ?"
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) {where}", (expression, user)).fetchone()[0]
+            rows = self._conn.execute(
+                f"""SELECT d.session_id, d.seq, d.role, d.timestamp, d.content, bm25(search_fts) AS score {where}
+                    ORDER BY score, d.timestamp DESC LIMIT ? OFFSET ?""",
+                (expression, user, limit, offset)
+            ).fetchall()
+        hits = []
+        for session_id, seq, role, timestamp, content, score in rows:
+            snippet, ranges = highlight(content, terms)
+            hits.append({
+                "session_id": session_id,
+                "seq": seq,
+                "role": role,
+                "timestamp": timestamp,
+                "snippet": snippet,
+                "highlights": ranges,
+                # bm25() is lower-is-better; flip it so clients can sort descending
+                "score": round(-score, 4),
+            })
+        self.stats["searches"] += 1
+        self.stats["search_ms_total"] += (time.perf_counter() - started) * 1000
+        return hits, total
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            docs = self._conn.execute("SELECT COUNT(*) FROM search_docs").fetchone()[0]
+            users = self._conn.execute("SELECT COUNT(*) FROM search_users").fetchone()[0]
+        searches = self.stats["searches"]
+        return {
+            "docs": docs,
+            "users_indexed": users,
+            "searches": searches,
+            "backfills": self.stats["backfills"],
+            "avg_search_ms": round(self.stats["search_ms_total"] / searches, 2) if searches else None,
+        }
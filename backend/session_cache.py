@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Hashable
+from session_store import ChatSession, safe_username
+
+# Rough per-message overhead on top of the text itself (dict, timestamp, role)
+MESSAGE_OVERHEAD_BYTES = 160
+
+def estimate_message_bytes(message: Dict) -> int:
+    """Approximate memory held by one message"""
+    return len(str(message.get("content", ""))) + MESSAGE_OVERHEAD_BYTES
+
+def estimate_session_bytes(session: ChatSession) -> int:
+    """Approximate memory held by a session's messages"""
+    return len(session.name) + sum(estimate_message_bytes(msg) for msg in session.messages)
+
+class _UserEntry:
+    def __init__(self, sessions: Dict[str, ChatSession], version: Hashable):
+        self.sessions = sessions
+        self.version = version
+        self.size = sum(estimate_session_bytes(s) for s in sessions.values())
+
+class SessionCache:
+    """Per-user cache of parsed sessions, bounded by user count and total message bytes (LRU).
+
+    Entries are keyed by the sanitized username, as in the session store, so
+    "Miku Fan" and "MikuFan" (the same stored user) share one entry.
+    """
+
+    def __init__(self, max_users: int = 64, max_bytes: int = 64 * 1024 * 1024):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _UserEntry]" = OrderedDict()
+        self._owners: Dict[str, str] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, username: str, version: Hashable) -> Optional[Dict[str, ChatSession]]:
+        """Return the user's sessions if cached and still at the given storage version"""
+        username = safe_username(username)
+        entry = self._entries.get(username)
+        if entry is not None and entry.version != version:
+            # Storage changed behind our back (another process or a manual edit)
+            self.invalidations += 1
+            self.invalidate(username)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(username)
+        return entry.sessions
+
+    def put(self, username: str, sessions: Dict[str, ChatSession], version: Hashable):
+        username = safe_username(username)
+        self.invalidate(username)
+        entry = _UserEntry(sessions, version)
+        self._entries[username] = entry
+        self.total_bytes += entry.size
+        for session_id in sessions:
+            self._owners[session_id] = username
+        self._evict(keep=username)
+
+    def owner_of(self, session_id: str) -> Optional[str]:
+        """(Sanitized) username whose cached sessions contain session_id"""
+        return self._owners.get(session_id)
+
+    def note_write(self, username: str, version: Hashable, session: Optional[ChatSession] = None,
+                   size_delta: int = 0, removed: Optional[str] = None):
+        """Record a write-through change so our own writes don't invalidate the entry"""
+        username = safe_username(username)
+        entry = self._entries.get(username)
+        if entry is None:
+            return
+        entry.version = version
+        self.add_bytes(username, size_delta)
+        if session is not None:
+            self._owners[session.id] = username
+        if removed is not None and self._owners.get(removed) == username:
+            del self._owners[removed]
+
+    def add_bytes(self, username: str, size_delta: int):
+        """Account for messages materialized into a cached user's sessions"""
+        username = safe_username(username)
+        entry = self._entries.get(username)
+        if entry is None:
+            return
+        entry.size += size_delta
+        self.total_bytes += size_delta
+        self._evict(keep=username)
+
+    def invalidate(self, username: str):
+        username = safe_username(username)
+        entry = self._entries.pop(username, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.size
+        for session_id in entry.sessions:
+            if self._owners.get(session_id) == username:
+                del self._owners[session_id]
+
+    def _evict(self, keep: str):
+        while (len(self._entries) > self.max_users or self.total_bytes > self.max_bytes) and len(self._entries) > 1:
+            username = next(iter(self._entries))
+            if username == keep:
+                self._entries.move_to_end(username)
+                username = next(iter(self._entries))
+            self.invalidate(username)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions
+        }
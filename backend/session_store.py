@@ -0,0 +1,395 @@
+import json
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, asdict
+from typing import List, Dict, Optional, Tuple
+
+@dataclass
+class ChatSession:
+    id: str
+    name: str
+    created_at: str
+    last_message_at: str
+    message_count: int
+    messages: List[Dict] = None
+    # Rolling summary of the first summary_upto messages, used for prompt context
+    summary: str = ""
+    summary_upto: int = 0
+
+    def __post_init__(self):
+        if self.messages is None:
+            self.messages = []
+        # False when loaded metadata-only; messages are then fetched on demand
+        self.messages_loaded = True
+
+def safe_username(username: str) -> str:
+    """Sanitize username for use in filenames and storage keys"""
+    return "".join(c for c in username if c.isalnum() or c in ('_', '-'))
+
+def legacy_json_path(storage_dir: str, username: str) -> str:
+    """Path of the old whole-file JSON storage for a user"""
+    return os.path.join(storage_dir, f"{safe_username(username)}_sessions.json")
+
+def read_legacy_json(path: str) -> List[ChatSession]:
+    """Parse a <user>_sessions.json file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return [ChatSession(**session_data) for session_data in data]
+
+def _ts(message: Dict) -> str:
+    return message.get("timestamp") or ""
+
+def paginate_messages(messages: List[Dict], limit: Optional[int] = None, before: Optional[str] = None,
+                      after: Optional[str] = None, offset: int = 0) -> Tuple[List[Dict], bool]:
+    """Take a window of chronologically ordered messages, returning (page, has_more).
+
+    With `after`, the window is the oldest messages newer than that timestamp;
+    otherwise it is the newest messages older than `before` (if given).
+    `offset` skips messages from the end the window starts at. A page never
+    splits messages that share a timestamp, so its first/last timestamp can be
+    passed back as an exclusive cursor.
+    """
+    if after is not None:
+        candidates = [m for m in messages if _ts(m) > after]
+        if limit is None:
+            return candidates[offset:], False
+        end = offset + limit
+        while 0 < end < len(candidates) and _ts(candidates[end]) == _ts(candidates[end - 1]):
+            end += 1
+        return candidates[offset:end], end < len(candidates)
+
+    candidates = messages if before is None else [m for m in messages if _ts(m) < before]
+    stop = len(candidates) - offset
+    if stop <= 0:
+        return [], False
+    if limit is None:
+        return candidates[:stop], False
+    start = max(0, stop - limit)
+    while 0 < start < stop and _ts(candidates[start - 1]) == _ts(candidates[start]):
+        start -= 1
+    return candidates[start:stop], start > 0
+
+class SessionStore(ABC):
+    """Persistence backend for chat sessions.
+
+    ChatManager updates the in-memory ChatSession first and then tells the
+    store what changed, so backends can write only the affected rows.
+    """
+
+    @abstractmethod
+    def load_sessions(self, username: str) -> List[ChatSession]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_session(self, username: str, session: ChatSession):
+        """Insert or update session metadata (name, timestamps, counts)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_message(self, username: str, session: ChatSession, message: Dict):
+        """Persist one new message; session metadata is already updated"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_session(self, username: str, session_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_all_messages(self, username: str) -> List[Tuple[str, int, Dict]]:
+        """Every stored message of a user as (session_id, seq, message)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_messages(self, username: str, session_id: str, limit: Optional[int] = None,
+                      before: Optional[str] = None, after: Optional[str] = None,
+                      offset: int = 0) -> Tuple[List[Dict], bool]:
+        """Fetch a window of one session's messages, see paginate_messages"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def version(self, username: str):
+        """Cheap token that changes when the user's data was modified outside this process"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def owner_of(self, session_id: str) -> Optional[str]:
+        """(Sanitized) username of the user a session belongs to, None if it is not stored"""
+        raise NotImplementedError
+
+class JsonSessionStore(SessionStore):
+    """Original storage: one JSON file per user, rewritten on every change.
+
+    Nothing is kept in memory here (ChatManager's SessionCache does that, within
+    its bounds); each call reads the user's file.
+    """
+
+    def __init__(self, storage_dir: str = "sessions"):
+        self.storage_dir = storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
+
+    def _read(self, username: str) -> Dict[str, ChatSession]:
+        storage_path = legacy_json_path(self.storage_dir, username)
+        if not os.path.exists(storage_path):
+            return {}
+        return {session.id: session for session in read_legacy_json(storage_path)}
+
+    def load_sessions(self, username: str) -> List[ChatSession]:
+        try:
+            return list(self._read(username).values())
+        except Exception as e:
+            print(f"Error loading sessions for {username}: {e}")
+            return []
+
+    def _update(self, username: str, change):
+        """Read the user's sessions, apply change(sessions) and write them back"""
+        try:
+            sessions = self._read(username)
+            change(sessions)
+            storage_path = legacy_json_path(self.storage_dir, username)
+            data = [asdict(session) for session in sessions.values()]
+            with open(storage_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"Error saving sessions for {username}: {e}")
+
+    def save_session(self, username: str, session: ChatSession):
+        self._update(username, lambda sessions: sessions.__setitem__(session.id, session))
+
+    def append_message(self, username: str, session: ChatSession, message: Dict):
+        self.save_session(username, session)
+
+    def delete_session(self, username: str, session_id: str):
+        self._update(username, lambda sessions: sessions.pop(session_id, None))
+
+    def load_messages(self, username: str, session_id: str, limit: Optional[int] = None,
+                      before: Optional[str] = None, after: Optional[str] = None,
+                      offset: int = 0) -> Tuple[List[Dict], bool]:
+        session = {s.id: s for s in self.load_sessions(username)}.get(session_id)
+        if session is None:
+            return [], False
+        return paginate_messages(session.messages, limit, before, after, offset)
+
+    def load_all_messages(self, username: str) -> List[Tuple[str, int, Dict]]:
+        return [
+            (session.id, seq, message)
+            for session in self.load_sessions(username)
+            for seq, message in enumerate(session.messages)
+        ]
+
+    def version(self, username: str):
+        try:
+            stat = os.stat(legacy_json_path(self.storage_dir, username))
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def owner_of(self, session_id: str) -> Optional[str]:
+        # No index in this format: scan every user's file
+        for name in os.listdir(self.storage_dir):
+            if not name.endswith("_sessions.json"):
+                continue
+            try:
+                sessions = read_legacy_json(os.path.join(self.storage_dir, name))
+            except Exception as e:
+                print(f"Error reading {name}: {e}")
+                continue
+            if any(session.id == session_id for session in sessions):
+                return name[:-len("_sessions.json")]
+        return None
+
+class SqliteSessionStore(SessionStore):
+    """SQLite (WAL) storage: session index table plus an append-only message table"""
+
+    def __init__(self, db_path: str = os.path.join("sessions", "sessions.db")):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                username TEXT NOT NULL,
+                id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                last_message_at TEXT NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                summary TEXT NOT NULL DEFAULT '',
+                summary_upto INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, id)
+            );
+            -- Finds a session's owner when only the id is known
+            CREATE INDEX IF NOT EXISTS sessions_by_id ON sessions (id);
+            CREATE TABLE IF NOT EXISTS messages (
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                timestamp TEXT,
+                data TEXT NOT NULL,
+                PRIMARY KEY (username, session_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS imported_users (
+                username TEXT PRIMARY KEY
+            );
+        """)
+        # Columns added after the first release of this schema
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "summary" not in columns:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN summary_upto INTEGER NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    def load_sessions(self, username: str) -> List[ChatSession]:
+        """Load session metadata only; messages are fetched with load_messages"""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT id, name, created_at, last_message_at, message_count, summary, summary_upto
+                   FROM sessions WHERE username = ?""",
+                (safe_username(username),)
+            ).fetchall()
+        sessions = []
+        for row in rows:
+            session = ChatSession(*row[:5], summary=row[5], summary_upto=row[6])
+            session.messages_loaded = False
+            sessions.append(session)
+        return sessions
+
+    def load_messages(self, username: str, session_id: str, limit: Optional[int] = None,
+                      before: Optional[str] = None, after: Optional[str] = None,
+                      offset: int = 0) -> Tuple[List[Dict], bool]:
+        user = safe_username(username)
+        base = "SELECT seq, timestamp, data FROM messages WHERE username = ? AND session_id = ?"
+        with self._lock:
+            if after is not None:
+                rows = self._conn.execute(
+                    base + " AND timestamp > ? ORDER BY seq LIMIT ? OFFSET ?",
+                    (user, session_id, after, -1 if limit is None else limit, offset)
+                ).fetchall()
+                if rows and limit is not None:
+                    # Don't split messages sharing the last timestamp across pages
+                    last_seq, last_ts = rows[-1][0], rows[-1][1]
+                    rows += self._conn.execute(
+                        base + " AND seq > ? AND timestamp = ? ORDER BY seq", (user, session_id, last_seq, last_ts)
+                    ).fetchall()
+                    has_more = self._conn.execute(
+                        "SELECT 1 FROM messages WHERE username = ? AND session_id = ? AND seq > ? LIMIT 1",
+                        (user, session_id, rows[-1][0])
+                    ).fetchone() is not None
+                else:
+                    has_more = False
+            else:
+                cursor = "" if before is None else " AND timestamp < ?"
+                params = (user, session_id) if before is None else (user, session_id, before)
+                rows = self._conn.execute(
+                    base + cursor + " ORDER BY seq DESC LIMIT ? OFFSET ?",
+                    params + (-1 if limit is None else limit, offset)
+                ).fetchall()
+                if rows and limit is not None:
+                    # Don't split messages sharing the first timestamp across pages
+                    first_seq, first_ts = rows[-1][0], rows[-1][1]
+                    rows += self._conn.execute(
+                        base + " AND seq < ? AND timestamp = ? ORDER BY seq DESC",
+                        (user, session_id, first_seq, first_ts)
+                    ).fetchall()
+                    has_more = self._conn.execute(
+                        "SELECT 1 FROM messages WHERE username = ? AND session_id = ? AND seq < ? LIMIT 1",
+                        (user, session_id, rows[-1][0])
+                    ).fetchone() is not None
+                else:
+                    has_more = False
+                rows.reverse()
+        return [json.loads(data) for _, _, data in rows], has_more
+
+    def _upsert_session(self, username: str, session: ChatSession):
+        self._conn.execute(
+            """INSERT INTO sessions (id, username, name, created_at, last_message_at, message_count,
+                                     summary, summary_upto)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(username, id) DO UPDATE SET
+                   name = excluded.name,
+                   last_message_at = excluded.last_message_at,
+                   message_count = excluded.message_count,
+                   summary = excluded.summary,
+                   summary_upto = excluded.summary_upto""",
+            (session.id, safe_username(username), session.name, session.created_at,
+             session.last_message_at, session.message_count, session.summary, session.summary_upto)
+        )
+
+    def save_session(self, username: str, session: ChatSession):
+        with self._lock, self._conn:
+            self._upsert_session(username, session)
+
+    def append_message(self, username: str, session: ChatSession, message: Dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO messages (username, session_id, seq, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                (safe_username(username), session.id, session.message_count - 1, message.get("timestamp"),
+                 json.dumps(message, ensure_ascii=False))
+            )
+            self._upsert_session(username, session)
+
+    def delete_session(self, username: str, session_id: str):
+        user = safe_username(username)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE username = ? AND id = ?", (user, session_id))
+            self._conn.execute("DELETE FROM messages WHERE username = ? AND session_id = ?", (user, session_id))
+
+    def load_all_messages(self, username: str) -> List[Tuple[str, int, Dict]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id, seq, data FROM messages WHERE username = ? ORDER BY session_id, seq",
+                (safe_username(username),)
+            ).fetchall()
+        return [(session_id, seq, json.loads(data)) for session_id, seq, data in rows]
+
+    def owner_of(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT username FROM sessions WHERE id = ? LIMIT 1", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def version(self, username: str):
+        # data_version only changes when another connection commits, so our own
+        # writes keep cached state valid while external edits invalidate it
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def is_imported(self, username: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM imported_users WHERE username = ?", (safe_username(username),)
+            ).fetchone()
+            return row is not None
+
+    def import_sessions(self, username: str, sessions: List[ChatSession]) -> int:
+        """Bulk-load sessions from the legacy JSON format (idempotent per session id)"""
+        imported = 0
+        user = safe_username(username)
+        with self._lock, self._conn:
+            for session in sessions:
+                exists = self._conn.execute(
+                    "SELECT 1 FROM sessions WHERE username = ? AND id = ?", (user, session.id)
+                ).fetchone()
+                if exists:
+                    continue
+                session.message_count = len(session.messages)
+                self._upsert_session(username, session)
+                self._conn.executemany(
+                    "INSERT INTO messages (username, session_id, seq, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (user, session.id, seq, message.get("timestamp"), json.dumps(message, ensure_ascii=False))
+                        for seq, message in enumerate(session.messages)
+                    ]
+                )
+                imported += 1
+            self._conn.execute("INSERT OR IGNORE INTO imported_users (username) VALUES (?)", (user,))
+        return imported
+
+def create_session_store(storage_dir: str = "sessions") -> SessionStore:
+    """Pick the backend from SESSION_STORE ("sqlite" by default, or "json")"""
+    backend = os.getenv("SESSION_STORE", "sqlite").lower()
+    if backend == "json":
+        return JsonSessionStore(storage_dir)
+    return SqliteSessionStore(os.path.join(storage_dir, "sessions.db"))
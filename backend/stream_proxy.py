@@ -0,0 +1,97 @@
+from typing import AsyncIterator, Dict, Optional
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+import httpx
+from http_client import HttpClient
+
+# Relay chunks start small so playback begins quickly, then double up to the max
+STREAM_MIN_CHUNK = 16 * 1024
+STREAM_MAX_CHUNK = 256 * 1024
+
+# Client request headers passed upstream, and upstream response headers passed back
+FORWARD_REQUEST_HEADERS = ("range", "if-range")
+FORWARD_RESPONSE_HEADERS = ("content-length", "content-range", "accept-ranges", "etag", "last-modified")
+
+AUDIO_TYPES = {
+    "m4a": "audio/mp4",
+    "mp4": "audio/mp4",
+    "m4s": "audio/mp4",
+    "aac": "audio/aac",
+    "mp3": "audio/mpeg",
+    "webm": "audio/webm",
+    "weba": "audio/webm",
+    "ogg": "audio/ogg",
+    "opus": "audio/ogg",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+}
+
+class UpstreamStatusError(Exception):
+    """The upstream answered with an error status before any bytes were relayed"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"Upstream returned HTTP {status_code}")
+        self.status_code = status_code
+
+def audio_media_type(ext: Optional[str], upstream_type: Optional[str] = None) -> str:
+    """Content-Type for an audio stream: from the container extension, else an upstream audio/* type"""
+    if ext and ext.lower() in AUDIO_TYPES:
+        return AUDIO_TYPES[ext.lower()]
+    upstream_type = (upstream_type or "").split(";")[0].strip()
+    if upstream_type.startswith("audio/"):
+        return upstream_type
+    # Bilibili's CDN labels DASH audio video/mp4 or octet-stream
+    return "audio/mp4"
+
+async def _relay(request: Request, response: httpx.Response) -> AsyncIterator[bytes]:
+    """Re-chunk the raw upstream body with a growing chunk size; stop as soon as the client leaves"""
+    chunk_size = STREAM_MIN_CHUNK
+    buffer = bytearray()
+    try:
+        async for data in response.aiter_raw():
+            buffer += data
+            if len(buffer) < chunk_size:
+                continue
+            if await request.is_disconnected():
+                break
+            yield bytes(buffer)
+            buffer.clear()
+            chunk_size = min(chunk_size * 2, STREAM_MAX_CHUNK)
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        # Also runs when the response task is cancelled on disconnect
+        await response.aclose()
+
+async def proxy_stream(request: Request, http: HttpClient, url: str, headers: Dict[str, str],
+                       ext: Optional[str] = None) -> StreamingResponse:
+    """Range-aware streaming proxy: forwards Range/If-Range and mirrors 200/206/416 responses"""
+    upstream_headers = dict(headers)
+    for name in FORWARD_REQUEST_HEADERS:
+        value = request.headers.get(name)
+        if value:
+            upstream_headers[name] = value
+
+    response = await http.open_stream("GET", url, headers=upstream_headers)
+    if response.status_code == 416:
+        await response.aclose()
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": response.headers.get("content-range", "bytes */*")})
+    if response.status_code >= 400:
+        await response.aclose()
+        raise UpstreamStatusError(response.status_code)
+
+    out_headers = {
+        name: response.headers[name] for name in FORWARD_RESPONSE_HEADERS if name in response.headers
+    }
+    out_headers.setdefault("accept-ranges", "bytes")
+    # Raw bytes are relayed, so an upstream Content-Encoding must be kept to match Content-Length
+    if "content-encoding" in response.headers:
+        out_headers["content-encoding"] = response.headers["content-encoding"]
+
+    return StreamingResponse(
+        _relay(request, response),
+        status_code=response.status_code,
+        media_type=audio_media_type(ext, response.headers.get("content-type")),
+        headers=out_headers,
+    )
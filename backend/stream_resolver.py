@@ -0,0 +1,132 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+import yt_dlp
+from cache_utils import SingleFlight
+
+# Resolved stream URLs kept in memory (LRU)
+RESOLVE_CACHE_SIZE = int(os.getenv("RESOLVE_CACHE_SIZE", "256"))
+# Lifetime assumed for URLs that carry no deadline/expires parameter
+RESOLVE_DEFAULT_TTL = float(os.getenv("RESOLVE_DEFAULT_TTL", "1800"))
+# Re-resolve in the background once a URL is this close to expiring
+RESOLVE_REFRESH_MARGIN = float(os.getenv("RESOLVE_REFRESH_MARGIN", "300"))
+# Never hand out a URL with less than this many seconds left
+RESOLVE_MIN_REMAINING = 30.0
+
+EXPIRY_PARAMS = ("deadline", "expires", "expire", "Expires")
+
+def url_expiry(url: str) -> Optional[float]:
+    """Unix time a signed CDN URL stops working, from its deadline/expires query parameter"""
+    query = parse_qs(urlsplit(url).query)
+    for name in EXPIRY_PARAMS:
+        for value in query.get(name, []):
+            try:
+                expiry = float(value)
+            except ValueError:
+                continue
+            # Some CDNs sign with milliseconds
+            return expiry / 1000 if expiry > 1e12 else expiry
+    return None
+
+def extract_stream(video_id: str) -> Dict:
+    """Run yt-dlp for a BV id or URL (blocking, several seconds)"""
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'quiet': True,
+        # 'cookiesfrombrowser': ('chrome', ) # Removed to avoid DB lock error
+    }
+    # Construct Bilibili URL if it looks like a BV ID
+    if video_id.startswith('BV'):
+        url_to_extract = f"https://www.bilibili.com/video/{video_id}"
+    else:
+        url_to_extract = video_id
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url_to_extract, download=False)
+
+class ResolvedStream:
+    def __init__(self, url: str, ext: Optional[str], expires_at: float,
+                 title: Optional[str] = None, thumbnail: Optional[str] = None):
+        self.url = url
+        self.ext = ext
+        self.expires_at = expires_at
+        self.title = title
+        self.thumbnail = thumbnail
+
+class StreamResolver:
+    """Cache of yt-dlp resolved stream URLs keyed by video id.
+
+    Entries live until shortly before the signed URL expires. Inside the
+    refresh margin the cached URL is still returned while a new one is
+    resolved in the background; concurrent resolutions of one id share a
+    single yt-dlp run.
+    """
+
+    def __init__(self, extract: Callable[[str], Dict] = extract_stream, max_entries: int = RESOLVE_CACHE_SIZE,
+                 default_ttl: float = RESOLVE_DEFAULT_TTL, refresh_margin: float = RESOLVE_REFRESH_MARGIN):
+        self.extract = extract
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.refresh_margin = refresh_margin
+        self._entries: "OrderedDict[str, ResolvedStream]" = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ytdlp")
+        self._flight = SingleFlight()
+        self._background: set = set()
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "forced": 0, "errors": 0}
+
+    async def _resolve(self, video_id: str) -> ResolvedStream:
+        loop = asyncio.get_event_loop()
+        try:
+            info = await loop.run_in_executor(self._executor, self.extract, video_id)
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        url = info['url']
+        expires_at = url_expiry(url) or time.time() + self.default_ttl
+        stream = ResolvedStream(url, info.get('ext'), expires_at, info.get('title'), info.get('thumbnail'))
+        self._entries[video_id] = stream
+        self._entries.move_to_end(video_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return stream
+
+    def _refresh_in_background(self, video_id: str):
+        if self._flight.in_flight(video_id):
+            return
+        self.stats["refreshes"] += 1
+        task = asyncio.ensure_future(self._flight.do(video_id, lambda: self._resolve(video_id)))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        # A failed refresh is retried by the next request
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def resolve(self, video_id: str, stale_url: Optional[str] = None) -> ResolvedStream:
+        """Stream URL for a video.
+
+        Pass stale_url when the upstream rejected it (e.g. 403): the entry is
+        re-resolved unless another request already replaced it.
+        """
+        entry = self._entries.get(video_id)
+        if entry is not None and stale_url is not None and entry.url == stale_url:
+            self.stats["forced"] += 1
+            del self._entries[video_id]
+            entry = None
+        if entry is not None:
+            remaining = entry.expires_at - time.time()
+            if remaining > RESOLVE_MIN_REMAINING:
+                self.stats["hits"] += 1
+                self._entries.move_to_end(video_id)
+                if remaining < self.refresh_margin:
+                    self._refresh_in_background(video_id)
+                return entry
+        self.stats["misses"] += 1
+        return await self._flight.do(video_id, lambda: self._resolve(video_id))
+
+    def invalidate(self, video_id: str):
+        self._entries.pop(video_id, None)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "entries": len(self._entries), "coalesced": self._flight.coalesced}
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+class TitleQueue:
+    """Background queue that generates session titles without blocking the first reply.
+
+    Jobs are deduplicated by session id, LLM calls are spaced at least
+    `min_interval` seconds apart, and failures are retried with exponential
+    backoff up to `max_attempts` times.
+    """
+
+    def __init__(self, generate: Callable[[str], Awaitable[Optional[str]]],
+                 apply: Callable[[str, str, str], None],
+                 min_interval: float = 1.0, max_attempts: int = 3, retry_delay: float = 2.0):
+        self.generate = generate
+        self.apply = apply
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # session_id -> (username, first_message)
+        self._pending: Dict[str, tuple] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._last_call = 0.0
+        self.completed = 0
+        self.failed = 0
+
+    def enqueue(self, session_id: str, username: str, first_message: str):
+        if session_id in self._pending:
+            return
+        self._pending[session_id] = (username, first_message)
+        self._ensure_worker()
+        self._queue.put_nowait((session_id, 1))
+
+    def discard(self, session_id: str):
+        """Drop a pending job, e.g. when the user renamed the session themselves"""
+        self._pending.pop(session_id, None)
+
+    def is_pending(self, session_id: str) -> bool:
+        return session_id in self._pending
+
+    def _ensure_worker(self):
+        # Created lazily so the queue binds to the running server loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            session_id, attempt = await self._queue.get()
+            job = self._pending.get(session_id)
+            if job is None:
+                continue
+            username, first_message = job
+
+            wait = self._last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last_call = time.monotonic()
+
+            try:
+                name = await self.generate(first_message)
+            except Exception as e:
+                print(f"Error generating session name: {e}")
+                name = None
+
+            if session_id not in self._pending:
+                # Discarded while we were generating
+                continue
+            if name:
+                del self._pending[session_id]
+                try:
+                    self.apply(session_id, username, name)
+                except Exception as e:
+                    # Keep the worker alive for the other sessions' titles
+                    print(f"Error applying session name: {e}")
+                    self.failed += 1
+                    continue
+                self.completed += 1
+            elif attempt < self.max_attempts:
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                asyncio.get_event_loop().call_later(delay, self._queue.put_nowait, (session_id, attempt + 1))
+            else:
+                del self._pending[session_id]
+                self.failed += 1
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "completed": self.completed, "failed": self.failed}
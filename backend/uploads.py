@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import uuid
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException, UploadFile
+from starlette.requests import Request
+from music_library import file_sha256
+
+# Largest audio file accepted, whole or resumable
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "500"))
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * 1024 * 1024)
+COVER_MAX_BYTES = 20 * 1024 * 1024
+# Read/write granularity when copying an upload to disk
+UPLOAD_COPY_CHUNK = 1024 * 1024
+# Suggested and maximum size of one resumable upload chunk
+RESUMABLE_CHUNK = 8 * 1024 * 1024
+RESUMABLE_MAX_CHUNK = 32 * 1024 * 1024
+# Temp files live inside music/ so the final rename is atomic (same filesystem)
+UPLOAD_TEMP_DIR = os.path.join("music", ".uploads")
+
+def safe_filename(name: Optional[str]) -> str:
+    """Strip directories and control characters from a client-supplied file name"""
+    name = os.path.basename((name or "").replace("\\", "/"))
+    name = re.sub(r"[\x00-\x1f]", "", name).strip()
+    if name in ("", ".", "..") or name.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return name
+
+def _temp_path(suffix: str = ".part") -> str:
+    os.makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+    return os.path.join(UPLOAD_TEMP_DIR, uuid.uuid4().hex + suffix)
+
+async def receive_upload(upload: UploadFile, max_bytes: int) -> Tuple[str, int, str]:
+    """Copy an UploadFile to a temp file in chunks; returns (temp path, size, sha256 hex).
+
+    Writes happen in a worker thread so the event loop never blocks on disk.
+    """
+    loop = asyncio.get_event_loop()
+    path = _temp_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            while True:
+                chunk = await upload.read(UPLOAD_COPY_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File exceeds {max_bytes // (1024 * 1024)} MB")
+                digest.update(chunk)
+                await loop.run_in_executor(None, f.write, chunk)
+    except BaseException:
+        discard(path)
+        raise
+    return path, size, digest.hexdigest()
+
+def discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def commit(temp_path: str, dest_path: str):
+    """Move a finished upload into place; readers never see a partial file"""
+    os.replace(temp_path, dest_path)
+
+class BodySizeLimitMiddleware:
+    """Reject request bodies over a per-path limit with 413, before they are spooled to disk.
+
+    A declared Content-Length over the limit is refused without reading the
+    body; chunked bodies are counted as they arrive.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        # path prefix -> max bytes, longest prefix wins
+        self.limits = sorted(limits.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def _limit_for(self, path: str) -> Optional[int]:
+        for prefix, limit in self.limits:
+            if path.startswith(prefix):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        limit = self._limit_for(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            await self._reject(send, limit)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside the app, so FastAPI turns it into a 413 response
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    @staticmethod
+    async def _reject(send, limit: int):
+        body = json.dumps({"detail": f"Request body exceeds {limit} bytes"}).encode()
+        await send({"type": "http.response.start", "status": 413, "headers": [
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+            (b"connection", b"close"),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+class ResumableUploads:
+    """Chunked uploads that survive dropped connections.
+
+    The client creates an upload with the final size, PUTs chunks at the
+    offset the server reports, and completes it; after a failure it asks
+    for the current offset and continues from there. State is kept next
+    to the partial file in UPLOAD_TEMP_DIR so it also survives restarts.
+    """
+
+    def __init__(self, temp_dir: str = UPLOAD_TEMP_DIR, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.temp_dir = temp_dir
+        self.max_bytes = max_bytes
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _paths(self, upload_id: str) -> Tuple[str, str]:
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+            raise HTTPException(status_code=404, detail="Upload not found")
+        base = os.path.join(self.temp_dir, upload_id)
+        return base + ".json", base + ".part"
+
+    def _load(self, upload_id: str) -> Dict:
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        # The partial file is the source of truth for how much has arrived
+        state["received"] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return state
+
+    def create(self, filename: str, size: int) -> Dict:
+        if size > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"File exceeds {self.max_bytes // (1024 * 1024)} MB")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path = self._paths(upload_id)
+        state = {"upload_id": upload_id, "filename": filename, "size": size}
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        open(part_path, "wb").close()
+        return {**state, "received": 0, "chunk_size": RESUMABLE_CHUNK}
+
+    def status(self, upload_id: str) -> Dict:
+        return {**self._load(upload_id), "chunk_size": RESUMABLE_CHUNK}
+
+    async def append(self, upload_id: str, offset: int, request: Request) -> Dict:
+        """Append the request body at `offset`, which must equal the bytes received so far"""
+        lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        async with lock:
+            state = self._load(upload_id)
+            if offset != state["received"]:
+                raise HTTPException(status_code=409, detail=f"Expected offset {state['received']}")
+            _, part_path = self._paths(upload_id)
+            loop = asyncio.get_event_loop()
+            received = state["received"]
+            with open(part_path, "ab") as f:
+                async for chunk in request.stream():
+                    received += len(chunk)
+                    if received > state["size"]:
+                        f.truncate(state["received"])
+                        raise HTTPException(status_code=413, detail="Chunk goes past the declared size")
+                    await loop.run_in_executor(None, f.write, chunk)
+            return {**state, "received": received}
+
+    async def finish(self, upload_id: str) -> Tuple[str, str, int, str]:
+        """Validate a fully received upload; returns (temp path, filename, size, sha256 hex)"""
+        lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        async with lock:
+            state = self._load(upload_id)
+            if state["received"] != state["size"]:
+                raise HTTPException(status_code=409, detail=f"Only {state['received']} of {state['size']} bytes received")
+            meta_path, part_path = self._paths(upload_id)
+            loop = asyncio.get_event_loop()
+            digest = await loop.run_in_executor(None, file_sha256, part_path)
+            discard(meta_path)
+        self._locks.pop(upload_id, None)
+        return part_path, state["filename"], state["size"], digest
+
+    def abort(self, upload_id: str):
+        for path in self._paths(upload_id):
+            discard(path)
+        self._locks.pop(upload_id, None)
@@ -42,7 +42,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
         const loadSessionMessages = async () => {
             if (activeSessionId) {
                 try {
-                    const response = await fetch(`http://localhost:8000/api/sessions/${activeSessionId}/messages`);
+                    const response = await fetch(`http://localhost:8000/api/sessions/${activeSessionId}/messages?username=${encodeURIComponent(currentUser)}`);
                     const data = await response.json();
 
                     // Convert backend messages to frontend format
@@ -50,7 +50,8 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
                         id: `${activeSessionId}-${index}`,
                         text: msg.content,
                         sender: msg.role === 'user' ? 'user' : 'miku',
-                        timestamp: new Date(msg.timestamp)
+                        timestamp: new Date(msg.timestamp),
+                        image: msg.image ? `http://localhost:8000/api/images/${msg.image}` : undefined
                     }));
 
                     setMessages(loadedMessages);
@@ -70,7 +71,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
         };
 
         loadSessionMessages();
-    }, [activeSessionId]);
+    }, [activeSessionId, currentUser]);
 
     // Random status messages
     const statusMessages = [
@@ -140,16 +141,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
                 formData.append('session_id', activeSessionId);
             }
 
-            // Prepare history (last 3 rounds = last 6 messages, excluding the current new one)
-            const historyMessages = messages
-                .slice(-6) // Get last 6 messages
-                .filter(msg => !msg.image) // Filter out messages with images for now (text-only history)
-                .map(msg => ({
-                    role: msg.sender === 'user' ? 'user' : 'model',
-                    content: msg.text
-                }));
-
-            formData.append('history', JSON.stringify(historyMessages));
+            // Conversation history is assembled by the server from the stored session
 
             const response = await fetch('http://localhost:8000/api/chat', {
                 method: 'POST',
@@ -5,7 +5,7 @@ import { Disc, Play, Pause, SkipForward, SkipBack, Music, Search, Globe, Folder,
 interface Song {
     name: string;
     url: string;
-    type: 'local' | 'online';
+    type: 'local' | 'online' | 'cached';
     id?: string;
     duration?: number;
     uploader?: string;